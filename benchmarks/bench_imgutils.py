@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark suite for imgutils.
+
+Runs every registered benchmark over synthetic data of several sizes,
+modes and batch sizes, and writes the results as JSON. A previous
+result file can be given as a baseline to spot regressions:
+
+    python benchmarks/bench_imgutils.py -o baseline.json
+    # ... change code ...
+    python benchmarks/bench_imgutils.py -o new.json --compare baseline.json
+
+With --compare, exits with status 1 if any case got slower than the
+baseline by more than --threshold, failed, or is missing from the
+new run.
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import numpy as np
+from PIL import Image
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+import imgutils  # noqa: E402
+
+
+BENCHMARKS = []
+
+# temporary directories removed at exit
+_cleanup = []
+
+
+def benchmark(name, **grid):
+    """ Register `setup(**params)`, returning the callable to time, for
+    every combination of parameters in `grid`. `setup` may also return
+    (callable, info), with info a dict of extra metrics to report, e.g.
+    output quality.
+    """
+    def register(setup):
+        keys = sorted(grid)
+        for values in itertools.product(*[grid[k] for k in keys]):
+            BENCHMARKS.append((name, dict(zip(keys, values)), setup))
+        return setup
+    return register
+
+
+def case_id(name, params):
+    return '{}[{}]'.format(name, ','.join(
+        '{}={}'.format(k, _fmt(params[k])) for k in sorted(params)))
+
+
+def _fmt(v):
+    if isinstance(v, tuple):
+        return 'x'.join(str(x) for x in v)
+    return str(v)
+
+
+_rng = np.random.RandomState(0)
+
+_CHANNELS = {'L': 1, 'RGB': 3, 'RGBA': 4}
+
+
+def random_array(wh, mode='RGB', batch=None):
+    w, h = wh
+    shape = (h, w) if mode == 'L' else (h, w, _CHANNELS[mode])
+    if batch is not None:
+        shape = (batch,) + shape
+    return _rng.randint(0, 256, shape).astype('uint8')
+
+
+def random_image(wh, mode='RGB'):
+    """ smooth-ish random image, so resampling has real work to do """
+    w, h = wh
+    small = random_array((max(1, w//8), max(1, h//8)), mode)
+    noise = random_array(wh, mode)
+    img = Image.fromarray(small).resize((w, h), Image.BILINEAR)
+    return Image.blend(img, Image.fromarray(noise), 0.25)
+
+
+def random_label_image(wh, num_labels, dtype='uint8', sparse=False):
+    w, h = wh
+    labels = np.arange(num_labels)
+    if sparse:
+        labels = labels*100003 + 10**6
+    return labels[_rng.randint(0, num_labels, (h, w))].astype(dtype)
+
+
+def psnr(a, b):
+    mse = np.mean((np.asarray(a, 'float64') - np.asarray(b, 'float64'))**2)
+    return float('inf') if mse == 0 else 10*np.log10(255.**2/mse)
+
+
+def random_colors(n):
+    colors = set()
+    while len(colors) < n:
+        colors.add(tuple(int(c) for c in _rng.randint(0, 256, 3)))
+    return sorted(colors)
+
+
+SIZES = [(640, 480), (1920, 1080)]
+
+
+# resizing
+
+@benchmark('letterbox_resize', size=SIZES, mode=['L', 'RGB'],
+           target=[(224, 224)])
+def bench_letterbox_resize(size, mode, target):
+    img = random_image(size, mode)
+    return lambda: imgutils.letterbox_resize(img, target)
+
+
+@benchmark('smart_resize', size=SIZES, mode=['L', 'RGB'],
+           target=[(256, None)])
+def bench_smart_resize(size, mode, target):
+    img = random_image(size, mode)
+    return lambda: imgutils.smart_resize(img, target)
+
+
+@benchmark('letterbox_resize_cached', size=SIZES, target=[(224, 224)])
+def bench_letterbox_resize_cached(size, target):
+    img = random_image(size)
+    cache = imgutils.ResizeCache()
+    return lambda: imgutils.letterbox_resize(img, target, cache=cache)
+
+
+@benchmark('resize_reducing_gap', size=[(1920, 1080), (7680, 4320)],
+           gap=[None, 1.0, 2.0, 3.0])
+def bench_resize_reducing_gap(size, gap):
+    img = random_image(size)
+    target = (224, None)
+    exact = imgutils.smart_resize(img, target)
+    fast = imgutils.smart_resize(img, target, reducing_gap=gap)
+    return (lambda: imgutils.smart_resize(img, target, reducing_gap=gap),
+            {'psnr': psnr(exact, fast)})
+
+
+@benchmark('crop_letterbox', size=SIZES, fused=[False, True])
+def bench_crop_letterbox(size, fused):
+    img = random_image(size)
+    crop_wh = (size[1]*3//4, size[1]*3//4)
+    if not fused:
+        return lambda: imgutils.letterbox_resize(
+            imgutils.crop_center(img, crop_wh), (224, 224))
+    box = imgutils.center_box(img.size, crop_wh)
+    canvas = Image.new(img.mode, (224, 224))
+    return lambda: imgutils.crop_resize(img, box, (224, 224), letterbox=True,
+                                        reducing_gap=2.0, out=canvas)
+
+
+@benchmark('resize_jpeg', size=[(6000, 4000)], target=[(256, None)],
+           decode=['full', 'draft'])
+def bench_resize_jpeg(size, target, decode):
+    f = io.BytesIO()
+    random_image(size).save(f, 'JPEG', quality=90)
+    data = f.getvalue()
+    if decode == 'full':
+        return lambda: imgutils.smart_resize(Image.open(io.BytesIO(data)),
+                                             target)
+    return lambda: imgutils.smart_resize_file(io.BytesIO(data), target)
+
+
+# montages
+
+@benchmark('square_montage', num_tiles=[16, 256], resize_mode=['center',
+                                                               'none'])
+def bench_square_montage(num_tiles, resize_mode):
+    imgs = [random_image((64, 48)) for _ in range(num_tiles)]
+    return lambda: imgutils.square_montage(imgs, resize_mode=resize_mode)
+
+
+@benchmark('montage', num_tiles=[64, 256])
+def bench_montage(num_tiles):
+    imgs = [random_image((64, 48)) for _ in range(num_tiles)]
+    ncols = int(np.ceil(np.sqrt(num_tiles)))
+    return lambda: imgutils.montage(imgs, ncols, ncols)
+
+
+@benchmark('write_montage', num_tiles=[256])
+def bench_write_montage(num_tiles):
+    imgs = [random_image((64, 48)) for _ in range(num_tiles)]
+    layout = imgutils.MontageLayout(num_tiles, (64, 48))
+    out = np.empty(layout.size[::-1] + (3,), dtype='uint8')
+    return lambda: imgutils.write_montage(imgs, layout, out)
+
+
+@benchmark('build_pyramid', size=[(2048, 2048)], scheme=['dzi'])
+def bench_build_pyramid(size, scheme):
+    img = random_image(size)
+    out_dir = tempfile.mkdtemp()
+    _cleanup.append(out_dir)
+    return lambda: imgutils.build_pyramid(img, out_dir, scheme=scheme)
+
+
+# drawing
+
+@benchmark('draw_bboxes', num_boxes=[10, 1000])
+def bench_draw_bboxes(num_boxes):
+    arr = random_array((640, 480))
+    xy = _rng.randint(0, 600, (num_boxes, 2))
+    boxes = np.hstack([xy, xy + _rng.randint(2, 40, (num_boxes, 2))])
+    return lambda: imgutils.draw_bboxes(arr, boxes)
+
+
+@benchmark('draw_labels', num_boxes=[10, 100])
+def bench_draw_labels(num_boxes):
+    arr = random_array((640, 480))
+    xy = _rng.randint(0, 600, (num_boxes, 2))
+    boxes = np.hstack([xy, xy + 20])
+    labels = ['class{}'.format(i % 10) for i in range(num_boxes)]
+    return lambda: imgutils.draw_labels(arr, boxes, labels)
+
+
+# stacking
+
+@benchmark('hstack', batch=[8, 64], backend=['pil', 'array'])
+def bench_hstack(batch, backend):
+    arr = random_array((224, 224), 'RGB', batch)
+    if backend == 'pil':
+        imgs = [Image.fromarray(a) for a in arr]
+        return lambda: imgutils.hstack(imgs)
+    out = np.empty((batch*224, 224, 3), dtype='uint8')
+    return lambda: imgutils.hstack(arr, out=out)
+
+
+@benchmark('dstack_rgb', size=SIZES, backend=['pil', 'array'])
+def bench_dstack_rgb(size, backend):
+    plane = random_array(size, 'L')
+    if backend == 'pil':
+        img = Image.fromarray(plane)
+        return lambda: imgutils.dstack_rgb([img, None, img])
+    out = np.empty(plane.shape + (3,), dtype='uint8')
+    return lambda: imgutils.dstack_rgb([plane, None, plane], out=out)
+
+
+# tensors
+
+@benchmark('images_to_tensor4', batch=[8, 64], mode=['L', 'RGB', 'RGBA'],
+           order=['nchw', 'nhwc'], dtype=['uint8', 'float32'])
+def bench_images_to_tensor4(batch, mode, order, dtype):
+    imgs = [random_image((224, 224), mode) for _ in range(batch)]
+    kwargs = {}
+    if dtype != 'uint8':
+        kwargs = dict(mean=127.5, std=64.)
+    return lambda: imgutils.images_to_tensor4(imgs, order, dtype=dtype,
+                                              **kwargs)
+
+
+@benchmark('images_to_tensor4_loop', batch=[64], mode=['L', 'RGB', 'RGBA'],
+           order=['nchw', 'nhwc'])
+def bench_images_to_tensor4_loop(batch, mode, order):
+    """ reference: one np.asarray copy per image, as before threading """
+    imgs = [random_image((224, 224), mode) for _ in range(batch)]
+    c = _CHANNELS[mode]
+    shape = (batch, 224, 224, c) if order == 'nhwc' else (batch, c, 224, 224)
+
+    def loop():
+        out = np.empty(shape, dtype='uint8')
+        for i, img in enumerate(imgs):
+            arr = np.asarray(img).reshape(224, 224, c)
+            if order == 'nchw':
+                arr = arr.transpose((2, 0, 1))
+            out[i] = arr
+        return out
+    return loop
+
+
+@benchmark('images_to_tensor4_paths', batch=[64], mode=['RGB'])
+def bench_images_to_tensor4_paths(batch, mode):
+    d = tempfile.mkdtemp()
+    _cleanup.append(d)
+    paths = []
+    for i in range(batch):
+        paths.append(os.path.join(d, '{}.png'.format(i)))
+        random_image((224, 224), mode).save(paths[-1], compress_level=1)
+    return lambda: imgutils.images_to_tensor4(paths, 'nhwc')
+
+
+@benchmark('tensor4_to_images', batch=[8, 64], mode=['L', 'RGB'],
+           order=['nchw', 'nhwc'])
+def bench_tensor4_to_images(batch, mode, order):
+    t = random_array((224, 224), mode, batch)
+    if t.ndim == 3:
+        t = t[..., np.newaxis]
+    if order == 'nchw':
+        t = np.ascontiguousarray(t.transpose(0, 3, 1, 2))
+    return lambda: imgutils.tensor4_to_images(t, order)
+
+
+# remapping
+
+@benchmark('rgb_image_to_label_image', size=SIZES, num_colors=[8, 64])
+def bench_rgb_image_to_label_image(size, num_colors):
+    colors = random_colors(num_colors)
+    mapping = dict((c, i) for i, c in enumerate(colors))
+    img = np.array(colors, dtype='uint8')[
+        random_label_image(size, num_colors)]
+    return lambda: imgutils.rgb_image_to_label_image(img, mapping)
+
+
+@benchmark('rgb_images_to_label_images', batch=[16], num_colors=[32])
+def bench_rgb_images_to_label_images(batch, num_colors):
+    colors = random_colors(num_colors)
+    mapping = dict((c, i) for i, c in enumerate(colors))
+    labels = _rng.randint(0, num_colors, (batch, 256, 256))
+    imgs = np.array(colors, dtype='uint8')[labels]
+    return lambda: imgutils.rgb_images_to_label_images(imgs, mapping)
+
+
+@benchmark('label_image_to_rgb_image', size=SIZES, num_labels=[20, 1000])
+def bench_label_image_to_rgb_image(size, num_labels):
+    dtype = 'uint8' if num_labels <= 256 else 'int32'
+    img = random_label_image(size, num_labels, dtype)
+    colors = random_colors(num_labels)
+    mapping = dict(enumerate(colors))
+    return lambda: imgutils.label_image_to_rgb_image(img, mapping)
+
+
+@benchmark('remap_labels', size=SIZES, keys=['uint8', 'int32', 'sparse'])
+def bench_remap_labels(size, keys):
+    if keys == 'sparse':
+        img = random_label_image(size, 50, 'int64', sparse=True)
+    else:
+        img = random_label_image(size, 50, keys)
+    mapping = dict((int(k), i % 5) for i, k in enumerate(np.unique(img)))
+    return lambda: imgutils.remap_labels(img, mapping)
+
+
+@benchmark('remap_labels_tiled', size=[(1920, 1080)])
+def bench_remap_labels_tiled(size):
+    img = random_label_image(size, 50, 'int32')
+    mapping = dict((i, i % 5) for i in range(50))
+    out = np.empty(img.shape, dtype='int8')
+    return lambda: imgutils.remap_labels_tiled(img, mapping, out=out)
+
+
+@benchmark('rgb_image_to_label_image_tiled', size=[(1920, 1080)])
+def bench_rgb_image_to_label_image_tiled(size):
+    colors = random_colors(32)
+    mapping = dict((c, i) for i, c in enumerate(colors))
+    img = np.array(colors, dtype='uint8')[random_label_image(size, 32)]
+    out = np.empty(img.shape[:2], dtype='uint32')
+    return lambda: imgutils.rgb_image_to_label_image_tiled(img, mapping,
+                                                           out=out)
+
+
+@benchmark('label_image_to_rgb_image_tiled', size=[(1920, 1080)])
+def bench_label_image_to_rgb_image_tiled(size):
+    img = random_label_image(size, 32)
+    mapping = dict(enumerate(random_colors(32)))
+    out = np.empty(img.shape + (3,), dtype='uint8')
+    return lambda: imgutils.label_image_to_rgb_image_tiled(img, mapping,
+                                                           out=out)
+
+
+# palettes
+
+@benchmark('add_color_palette', size=SIZES, palette=['list', 'dict'])
+def bench_add_color_palette(size, palette):
+    img = random_label_image(size, 20)
+    colors = random_colors(20)
+    mapping = colors if palette == 'list' else dict(enumerate(colors))
+    return lambda: imgutils.add_color_palette(img, mapping)
+
+
+@benchmark('palette_png', size=SIZES, compress_level=[1, 6])
+def bench_palette_png(size, compress_level):
+    labels = random_label_image(size, 20)
+    palette = imgutils.get_palette(random_colors(20))
+
+    def save():
+        f = io.BytesIO()
+        palette.save(labels, f, compress_level=compress_level)
+        return f
+    return save, {'kbytes': len(save().getvalue())/1024.}
+
+
+def time_case(func, repeat, min_time):
+    """ best and median seconds per call, calibrating calls per repeat """
+    timer = timeit.Timer(func)
+    number, elapsed = 1, timer.timeit(1)
+    while elapsed < min_time and number < 10**6:
+        number *= 10 if elapsed < min_time/10 else 2
+        elapsed = timer.timeit(number)
+    times = sorted(t/number for t in timer.repeat(repeat, number))
+    return {'best': times[0], 'median': times[len(times)//2],
+            'number': number, 'repeat': repeat}
+
+
+def run(pattern=None, repeat=5, min_time=0.05, verbose=True):
+    results = {}
+    for name, params, setup in BENCHMARKS:
+        cid = case_id(name, params)
+        if pattern and pattern not in cid:
+            continue
+        try:
+            func = setup(**params)
+            info = None
+            if isinstance(func, tuple):
+                func, info = func
+            result = time_case(func, repeat, min_time)
+            if info:
+                result['info'] = info
+        except Exception as e:
+            result = {'error': '{}: {}'.format(type(e).__name__, e)}
+        result.update(name=name, params=dict(
+            (k, _fmt(v)) for k, v in params.items()))
+        results[cid] = result
+        if verbose:
+            if 'error' in result:
+                print('{:<70} ERROR {}'.format(cid, result['error']))
+            else:
+                print('{:<70} {:10.3f} ms {}'.format(
+                    cid, result['best']*1e3, ' '.join(
+                        '{}={:.4g}'.format(k, v)
+                        for k, v in sorted(result.get('info', {}).items()))))
+            sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, threshold, pattern=None):
+    """ print ratio to baseline per case; returns the regressed cases.
+
+    Cases that fail in the new run, and baseline cases missing from it
+    (among those selected by `pattern`), count as regressions too.
+    """
+    regressed = []
+    print('\n{:<70} {:>10} {:>10} {:>7}'.format(
+        'case', 'base ms', 'new ms', 'ratio'))
+    for cid in sorted(results):
+        new, old = results[cid], baseline.get(cid)
+        if 'error' in new:
+            print('{:<70} ERROR {}'.format(cid, new['error']))
+            regressed.append(cid)
+            continue
+        if old is None or 'best' not in old:
+            continue
+        ratio = new['best']/old['best']
+        flag = ''
+        if ratio > threshold:
+            flag = '  SLOWER'
+            regressed.append(cid)
+        elif ratio < 1./threshold:
+            flag = '  faster'
+        print('{:<70} {:10.3f} {:10.3f} {:7.2f}{}'.format(
+            cid, old['best']*1e3, new['best']*1e3, ratio, flag))
+    for cid in sorted(baseline):
+        if cid not in results and (not pattern or pattern in cid):
+            print('{:<70} MISSING from new run'.format(cid))
+            regressed.append(cid)
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('-k', dest='pattern',
+                        help='only run cases containing this string')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio counted as a regression')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='minimum seconds per timing repeat')
+    args = parser.parse_args(argv)
+
+    try:
+        results = run(args.pattern, args.repeat, args.min_time)
+    finally:
+        for d in _cleanup:
+            shutil.rmtree(d, ignore_errors=True)
+    report = {
+        'meta': {
+            'imgutils': imgutils.__version__,
+            'numpy': np.__version__,
+            'pillow': getattr(Image, '__version__', None),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressed = compare(results, baseline, args.threshold,
+                            args.pattern)
+        if regressed:
+            print('\n{} regressions (errors, missing cases, or slower '
+                  'than {:.2f}x)'.format(len(regressed), args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
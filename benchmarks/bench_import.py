@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Import-time benchmark for imgutils.
+
+Each scenario imports imgutils and touches one name in a fresh
+interpreter, and reports the best wall time over several runs. With
+--check, exits with status 1 if a scenario imports a module it should
+not (e.g. numpy just for ImgDims) or exceeds its time budget, or if
+the lazy name table in imgutils/__init__.py is out of sync with the
+submodules' __all__.
+
+    python benchmarks/bench_import.py --check
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# name touched, modules that must stay unimported, time budget in ms
+SCENARIOS = [
+    ('ImgDims', ['numpy', 'PIL'], 50),
+    ('remap_labels', ['PIL'], 400),
+    ('letterbox_resize', ['imgutils.remapping', 'imgutils.text'], 600),
+    ('render_montage', ['imgutils.pyramid', 'imgutils.text'], 800),
+]
+
+_SNIPPET = """
+import sys, time, json
+t = time.time()
+import imgutils
+getattr(imgutils, {name!r})
+dt = time.time() - t
+print(json.dumps({{'ms': dt*1000.,
+                   'loaded': [m for m in {forbidden!r} if m in sys.modules]}}))
+"""
+
+
+def run_scenario(name, forbidden, repeat):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [_ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    results = []
+    for _ in range(repeat):
+        out = subprocess.check_output(
+            [sys.executable, '-c',
+             _SNIPPET.format(name=name, forbidden=forbidden)], env=env)
+        results.append(json.loads(out.decode('utf-8')))
+    return (min(r['ms'] for r in results),
+            sorted(set(m for r in results for m in r['loaded'])))
+
+
+def check_exports():
+    """ Compare imgutils._SUBMODULE_NAMES with every submodule's
+    __all__. Modules listed with no names are deliberately not
+    re-exported, and only need to exist. Returns a list of problems.
+    """
+    sys.path.insert(0, _ROOT)
+    import imgutils
+    table = imgutils._SUBMODULE_NAMES
+    package_dir = os.path.dirname(imgutils.__file__)
+    found = set(f[:-3] for f in os.listdir(package_dir)
+                if f.endswith('.py') and f != '__init__.py')
+    problems = ['{}: missing from _SUBMODULE_NAMES'.format(m)
+                for m in sorted(found - set(table))]
+    problems += ['{}: no such submodule'.format(m)
+                 for m in sorted(set(table) - found)]
+    for module in sorted(set(table) & found):
+        names = table[module]
+        if not names:
+            continue
+        exported = importlib.import_module('imgutils.' + module).__all__
+        for name in sorted(set(exported) - set(names)):
+            problems.append('{}.{}: missing from _SUBMODULE_NAMES'.format(
+                module, name))
+        for name in sorted(set(names) - set(exported)):
+            problems.append('{}.{}: not in __all__'.format(module, name))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--check', action='store_true',
+                        help='exit with status 1 on regressions')
+    parser.add_argument('--slack', type=float, default=1.0,
+                        help='multiply time budgets, for slow machines')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for name, forbidden, budget_ms in SCENARIOS:
+        ms, loaded = run_scenario(name, forbidden, args.repeat)
+        budget_ms *= args.slack
+        ok = not loaded and ms <= budget_ms
+        failed = failed or not ok
+        print('{:<20} {:8.1f} ms (budget {:6.0f} ms){}{}'.format(
+            name, ms, budget_ms,
+            '' if not loaded else '  imported: ' + ', '.join(loaded),
+            '' if ok else '  FAIL'))
+    problems = check_exports()
+    for problem in problems:
+        print('exports: ' + problem)
+    if not problems:
+        print('exports: _SUBMODULE_NAMES matches every __all__')
+    failed = failed or bool(problems)
+    if args.check and failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,101 @@
 # -*- coding: utf-8 -*-
 
-"""Top-level package for imgutils."""
+"""Top-level package for imgutils.
+
+Submodules are imported lazily, the first time one of their names is
+used, so e.g. ``from imgutils import ImgDims`` does not import numpy or
+PIL.
+"""
 
 __author__ = """Daniel Maturana"""
 __email__ = 'dimatura@cmu.edu'
 __version__ = '0.1.2'
 
 
-from .imgdims import *
-from .palette import *
-from .pil_utils import *
-from .remapping import *
+import importlib
+
+
+# public names of each submodule, i.e. their __all__
+_SUBMODULE_NAMES = {
+    # async versions share their names with pil_utils, use imgutils.aio
+    'aio': [],
+    'batch': ['SharedTensor', 'iter_preprocess_files', 'preprocess_files'],
+    'cache': ['ResizeCache', 'get_resize_cache'],
+    'compositing': ['LiveMontage',
+                    'MontageLayout',
+                    'iter_montage_bands',
+                    'render_montage',
+                    'write_montage'],
+    'imgdims': ['ImgDims'],
+    # functions are used through the module, imgutils.instrument
+    'instrument': [],
+    'np_pil_interop': ['BufferPool',
+                       'array_to_image',
+                       'can_share_memory',
+                       'image_to_array',
+                       'new_shared_image'],
+    'palette': ['Palette',
+                'add_color_palette',
+                'get_palette',
+                'save_palettized_pngs'],
+    'pipeline': ['Pipeline'],
+    'pil_utils': ['add_border',
+                  'center_box',
+                  'crop_center',
+                  'crop_resize',
+                  'draw_bbox',
+                  'draw_bboxes',
+                  'dstack_rgb',
+                  'hstack',
+                  'images_to_tensor4',
+                  'tensor4_to_images',
+                  'Tensor4Images',
+                  'letterbox_resize',
+                  'letterbox_resize_file',
+                  'montage',
+                  'smart_resize',
+                  'smart_resize_file',
+                  'square_montage',
+                  'trim_box',
+                  'trim_percentage',
+                  'vstack'],
+    'pyramid': ['build_pyramid', 'montage_pyramid'],
+    'remapping': ['ColorLabelMap',
+                  'LabelMap',
+                  'clear_compile_cache',
+                  'set_compile_cache_limits',
+                  'rgb_image_to_label_image',
+                  'rgb_images_to_label_images',
+                  'label_image_to_rgb_image',
+                  'remap_labels',
+                  'rgb_image_to_label_image_tiled',
+                  'label_image_to_rgb_image_tiled',
+                  'remap_labels_tiled'],
+    'text': ['TextAtlas',
+             'draw_labels',
+             'draw_tiny_text',
+             'get_text_atlas'],
+}
+
+_NAME_TO_SUBMODULE = dict((name, module)
+                          for module, names in _SUBMODULE_NAMES.items()
+                          for name in names)
+
+__all__ = sorted(_NAME_TO_SUBMODULE)
+
+
+def __getattr__(name):
+    if name in _SUBMODULE_NAMES:
+        return importlib.import_module('.' + name, __name__)
+    module = _NAME_TO_SUBMODULE.get(name)
+    if module is None:
+        raise AttributeError(
+            "module 'imgutils' has no attribute '{}'".format(name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    # cache, so __getattr__ is only called once per name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
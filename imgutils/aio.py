@@ -0,0 +1,176 @@
+
+"""Asyncio counterparts of the slower imgutils functions.
+
+Work runs in a thread pool (Pillow releases the GIL for most of it), so
+the event loop stays free. Calls go through an `AsyncRunner`, which
+bounds how many run at once and applies timeouts. Resizes and montages
+use separate default runners, so a burst of big montages can not take
+all the threads from small thumbnails.
+
+>>> import asyncio
+>>> from PIL import Image
+>>> async def thumbs():
+...     img = Image.new('RGB', (640, 480))
+...     return await asyncio.gather(*[smart_resize(img, (64, None))
+...                                   for _ in range(4)])
+>>> [img.size for img in asyncio.run(thumbs())]
+[(64, 48), (64, 48), (64, 48), (64, 48)]
+"""
+
+__all__ = ['AsyncRunner',
+           'get_runner',
+           'letterbox_resize',
+           'montage',
+           'set_runner',
+           'smart_resize',
+           'square_montage']
+
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import weakref
+
+from . import pil_utils
+
+
+_runners = {}
+_runners_lock = threading.Lock()
+
+
+class AsyncRunner(object):
+    """ Runs blocking functions in an executor with bounded concurrency.
+
+    A call holds one of `max_concurrency` slots from the moment its
+    function starts until it returns. Cancelling the awaiting task, or
+    running out of time, gives up on the result right away; a function
+    that already started keeps running in its thread, and keeps its slot
+    until it finishes, so the bound always reflects real work.
+
+    :parameters:
+        - max_concurrency: int
+            most calls running at once, defaults to number of cpus.
+        - executor: concurrent.futures executor to run calls in,
+            defaults to a new thread pool with max_concurrency threads.
+        - timeout: default timeout in seconds of each call, including
+            time waiting for a slot. None waits forever.
+
+    >>> import time
+    >>> runner = AsyncRunner(max_concurrency=1)
+    >>> async def late():
+    ...     slow = asyncio.ensure_future(runner.run(time.sleep, 0.2))
+    ...     try:
+    ...         await runner.run(int, '1', timeout=0.05)
+    ...     except asyncio.TimeoutError:
+    ...         return 'timed out', await slow
+    >>> asyncio.run(late())
+    ('timed out', None)
+    """
+
+    def __init__(self, max_concurrency=None, executor=None, timeout=None):
+        if max_concurrency is None:
+            max_concurrency = os.cpu_count() or 1
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be at least 1')
+        self.max_concurrency = max_concurrency
+        if executor is None:
+            executor = ThreadPoolExecutor(max_concurrency)
+        self.executor = executor
+        self.timeout = timeout
+        # asyncio semaphores belong to one event loop
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self, loop):
+        sem = self._semaphores.get(loop)
+        if sem is None:
+            sem = self._semaphores[loop] = asyncio.Semaphore(
+                self.max_concurrency)
+        return sem
+
+    async def run(self, func, *args, timeout=None, **kwargs):
+        """ await `func(*args, **kwargs)`, run in the executor. Raises
+        asyncio.TimeoutError after `timeout` seconds, or the runner
+        default if None.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return await self._run(func, args, kwargs)
+        return await asyncio.wait_for(self._run(func, args, kwargs),
+                                      timeout)
+
+    async def _run(self, func, args, kwargs):
+        loop = asyncio.get_running_loop()
+        sem = self._semaphore(loop)
+        await sem.acquire()
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except BaseException:
+            sem.release()
+            raise
+        # release when the function is really done, not when the caller
+        # stops waiting for it
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(sem.release))
+        # cancelling the wrapper also cancels calls not yet started
+        return await asyncio.wrap_future(future)
+
+
+def get_runner(name):
+    """ Default AsyncRunner of a kind of work, 'resize' or 'montage'.
+
+    Resizes may use all cpus, and montages half of them. Both share
+    one thread pool, with enough threads for both limits at once.
+    """
+    with _runners_lock:
+        if not _runners:
+            cpus = os.cpu_count() or 1
+            limits = {'resize': cpus, 'montage': max(1, cpus//2)}
+            executor = ThreadPoolExecutor(sum(limits.values()))
+            for kind, limit in limits.items():
+                _runners[kind] = AsyncRunner(limit, executor)
+        return _runners[name]
+
+
+def set_runner(name, runner):
+    """ Replace the default runner of a kind of work, see `get_runner`. """
+    get_runner(name)
+    with _runners_lock:
+        _runners[name] = runner
+
+
+async def smart_resize(img, img_wh, interp=None, runner=None, timeout=None,
+                       **kwargs):
+    """ async `smart_resize`. Runs in `runner`, by default
+    `get_runner('resize')`, with an optional timeout in seconds. Other
+    arguments are passed on.
+    """
+    runner = runner or get_runner('resize')
+    return await runner.run(pil_utils.smart_resize, img, img_wh, interp,
+                            timeout=timeout, **kwargs)
+
+
+async def letterbox_resize(img, img_wh, bg=None, interp=None, runner=None,
+                           timeout=None, **kwargs):
+    """ async `letterbox_resize`, see `smart_resize`. """
+    runner = runner or get_runner('resize')
+    return await runner.run(pil_utils.letterbox_resize, img, img_wh, bg,
+                            interp, timeout=timeout, **kwargs)
+
+
+async def square_montage(images, runner=None, timeout=None, **kwargs):
+    """ async `square_montage`. Runs in `runner`, by default
+    `get_runner('montage')`.
+    """
+    runner = runner or get_runner('montage')
+    return await runner.run(pil_utils.square_montage, list(images),
+                            timeout=timeout, **kwargs)
+
+
+async def montage(images, nrows, ncols, runner=None, timeout=None,
+                  **kwargs):
+    """ async `montage`, see `square_montage`. """
+    runner = runner or get_runner('montage')
+    return await runner.run(pil_utils.montage, list(images), nrows, ncols,
+                            timeout=timeout, **kwargs)
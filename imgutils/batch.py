@@ -0,0 +1,221 @@
+
+__all__ = ['SharedTensor', 'iter_preprocess_files', 'preprocess_files']
+
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from multiprocessing import shared_memory
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+from .np_pil_interop import image_to_array
+
+
+_MODE_CHANNELS = {'L': 1, 'RGB': 3, 'RGBA': 4}
+
+# state of each worker process, set by _init_worker
+_worker = {}
+
+
+def _attach(name):
+    """ open existing shared memory without taking ownership of it """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    # before 3.13 attaching also registers the segment with the resource
+    # tracker. pool workers share the tracker of their parent, where it
+    # is registered already, so this is harmless for them.
+    return shared_memory.SharedMemory(name)
+
+
+class SharedTensor(object):
+    """ ndarray backed by `multiprocessing.shared_memory`.
+
+    Created with no name, it allocates a new segment, and owns it: `close`
+    also unlinks it. Given the name of an existing segment, it attaches
+    to it instead, e.g. in another process.
+
+    :parameters:
+        - shape: tuple of ints
+        - dtype: numpy dtype
+        - name: optional name of an existing segment
+
+    >>> with SharedTensor((2, 4, 4, 3)) as t:
+    ...     other = SharedTensor(t.shape, name=t.name)
+    ...     other.array[1] = 7
+    ...     int(t.array[1, 0, 0, 0]), t.array.dtype.name
+    ...     other.close()
+    (7, 'uint8')
+    """
+
+    def __init__(self, shape, dtype='uint8', name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        if self.owner:
+            nbytes = max(1, int(np.prod(self.shape))*self.dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = _attach(name)
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        """ Release the segment. Arrays from `array` become invalid. """
+        if self.shm is None:
+            return
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _load(path, mode, transforms):
+    img = Image.open(path)
+    if img.mode != mode:
+        img = img.convert(mode)
+    for transform in transforms:
+        img = transform(img)
+    return img
+
+
+def _init_worker(name, shape, mode, transforms):
+    tensor = SharedTensor(shape, 'uint8', name=name)
+    _worker.update(tensor=tensor, mode=mode, transforms=transforms)
+
+
+def _process_chunk(start, paths):
+    arr = _worker['tensor'].array
+    for i, path in enumerate(paths, start):
+        img = _load(path, _worker['mode'], _worker['transforms'])
+        if img.mode != _worker['mode'] or \
+                img.size != (arr.shape[2], arr.shape[1]):
+            raise ValueError('{}: transforms gave a {} image of size {}, '
+                             'expected {} of size {}'.format(
+                                 path, img.mode, img.size, _worker['mode'],
+                                 (arr.shape[2], arr.shape[1])))
+        out = arr[i]
+        if out.shape[2] == 1:
+            out = out[..., 0]
+        image_to_array(img, out=out)
+    return start, start + len(paths)
+
+
+def iter_preprocess_files(paths, transforms, img_wh, out, mode='RGB',
+                          num_workers=None, chunk_size=16, ordered=True,
+                          max_in_flight=None, mp_context=None):
+    """ Load and transform image files in a process pool, writing the
+    results straight into a shared (N, H, W, C) uint8 tensor.
+
+    Workers write pixels into `out`, so only paths and index ranges go
+    through pickling. Yields (start, stop) index ranges of `out` as each
+    chunk is done.
+
+    :parameters:
+        - paths: sequence of N image paths
+        - transforms: sequence of functions taking and returning a PIL
+            image, applied in order after loading and converting to
+            `mode`. They must be picklable, e.g. module level functions
+            or `functools.partial` of them. The last one must give
+            images of size img_wh.
+        - img_wh: width, height of the output images
+        - out: SharedTensor of shape (N, H, W, C), e.g. from
+            `preprocess_files`
+        - mode: L, RGB or RGBA
+        - num_workers: int, defaults to number of cpus
+        - chunk_size: int
+            images per task
+        - ordered: bool
+            yield chunks in order of paths, or as soon as each is done.
+        - max_in_flight: int
+            most chunks submitted but not yet yielded, default is
+            2*num_workers. Bounds work queued ahead of the consumer.
+        - mp_context: optional multiprocessing context for the pool
+    """
+    w, h = img_wh
+    shape = (len(paths), h, w, _MODE_CHANNELS[mode])
+    if out.shape != shape or out.dtype != np.uint8:
+        raise ValueError('out must be a uint8 SharedTensor of shape '
+                         '{}'.format(shape))
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2*num_workers
+    chunks = deque((i, paths[i:i+chunk_size])
+                   for i in range(0, len(paths), chunk_size))
+
+    with ProcessPoolExecutor(num_workers, mp_context=mp_context,
+                             initializer=_init_worker,
+                             initargs=(out.name, shape, mode,
+                                       list(transforms))) as pool:
+        pending = deque()
+        try:
+            while chunks or pending:
+                while chunks and len(pending) < max_in_flight:
+                    pending.append(pool.submit(_process_chunk,
+                                               *chunks.popleft()))
+                if ordered:
+                    yield pending.popleft().result()
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def preprocess_files(paths, transforms, img_wh, mode='RGB', **kwargs):
+    """ Load and transform image files into a new SharedTensor of shape
+    (N, H, W, C), in a process pool. See `iter_preprocess_files` for
+    the parameters.
+
+    The caller owns the result, and should `close` it (or use it as a
+    context manager) when done with its `array`.
+
+    >>> import tempfile, functools
+    >>> from imgutils.pil_utils import letterbox_resize
+    >>> d = tempfile.mkdtemp()
+    >>> paths = [os.path.join(d, '{}.png'.format(i)) for i in range(5)]
+    >>> for i, p in enumerate(paths):
+    ...     Image.new('L', (20 + i, 10), 10*i).save(p)
+    >>> resize = functools.partial(letterbox_resize, img_wh=(8, 8))
+    >>> with preprocess_files(paths, [resize], (8, 8), num_workers=2,
+    ...                       chunk_size=2) as t:
+    ...     t.array.shape, t.array[:, 4, 4, 0].tolist()
+    ((5, 8, 8, 3), [0, 10, 20, 30, 40])
+    """
+    w, h = img_wh
+    out = SharedTensor((len(paths), h, w, _MODE_CHANNELS[mode]), 'uint8')
+    try:
+        for _ in iter_preprocess_files(paths, transforms, img_wh, out, mode,
+                                       **kwargs):
+            pass
+    except BaseException:
+        out.close()
+        raise
+    return out
+
+
+# relative imports need the package: python -m imgutils.batch
+if __name__ == '__main__':
+    import doctest
+    flags = doctest.REPORT_NDIFF
+    fail, total = doctest.testmod(optionflags=flags)
+    print("{} failures out of {} tests".format(fail, total))
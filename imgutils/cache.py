@@ -0,0 +1,196 @@
+
+__all__ = ['ResizeCache', 'get_resize_cache']
+
+
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+
+from PIL import Image
+
+
+# modes that round-trip losslessly through PNG, for the disk tier
+_PNG_MODES = ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I;16')
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def _image_nbytes(img):
+    return len(img.getbands())*img.size[0]*img.size[1] * \
+        (4 if img.mode in ('I', 'F') else 1)
+
+
+class ResizeCache(object):
+    """ LRU cache of resize results, keyed on image content.
+
+    Keys hash the pixels, mode, size and palette of the source image
+    along with the operation and its parameters, so equal images hit
+    the same entry regardless of where they came from. Hits return a
+    copy of the cached image, so callers may modify it freely.
+
+    Hashing reads every source pixel, which for big images costs about
+    as much as a `thumbnail` call; the cache pays off most for high
+    quality resamples. Callers that already have a cheap key, like a
+    file path and mtime, can use `get` and `put` directly.
+
+    :parameters:
+        - max_bytes: int
+            memory budget for cached images; least recently used ones
+            are evicted first.
+        - disk_dir: optional directory for a second, unbounded tier.
+            Images evicted from memory stay on disk as PNG, and memory
+            misses are looked up there before recomputing.
+
+    >>> cache = ResizeCache(max_bytes=2**20)
+    >>> img = Image.new('RGB', (64, 64), (10, 20, 30))
+    >>> calls = []
+    >>> resize = lambda: calls.append(1) or img.resize((8, 8))
+    >>> a = cache.get_or_compute('resize', img, (8, 8), resize)
+    >>> b = cache.get_or_compute('resize', img.copy(), (8, 8), resize)
+    >>> len(calls), a.tobytes() == b.tobytes()
+    (1, True)
+    >>> s = cache.stats()
+    >>> s['hits'], s['misses'], s['entries'], s['bytes']
+    (1, 1, 1, 192)
+    """
+
+    def __init__(self, max_bytes=2**28, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        if disk_dir is not None and not os.path.isdir(disk_dir):
+            os.makedirs(disk_dir)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = self._disk_hits = self._misses = self._evictions = 0
+
+    def key(self, op, img, params):
+        """ hex digest identifying `op(img, *params)` """
+        h = hashlib.sha1()
+        h.update(repr((op, img.mode, img.size, params)).encode('utf-8'))
+        if img.mode == 'P':
+            h.update(bytes(img.getpalette() or ()))
+        h.update(img.tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        """ copy of the cached image, or None """
+        with self._lock:
+            img = self._entries.pop(key, None)
+            if img is not None:
+                self._entries[key] = img
+                self._hits += 1
+                return img.copy()
+        img = self._load(key)
+        with self._lock:
+            if img is None:
+                self._misses += 1
+                return None
+            self._disk_hits += 1
+        self._insert(key, img)
+        return img.copy()
+
+    def put(self, key, img):
+        """ store a copy of `img` under `key` """
+        img = img.copy()
+        self._insert(key, img)
+        self._save(key, img)
+
+    def get_or_compute(self, op, img, params, compute):
+        """ cached result of `compute()`, which should return
+        `op(img, *params)`.
+        """
+        key = self.key(op, img, params)
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def _insert(self, key, img):
+        nbytes = _image_nbytes(img)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= _image_nbytes(old)
+            self._entries[key] = img
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= _image_nbytes(evicted)
+                self._evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + '.png')
+
+    def _load(self, key):
+        if self.disk_dir is None:
+            return None
+        try:
+            img = Image.open(self._path(key))
+            img.load()
+        except (IOError, OSError):
+            return None
+        return img
+
+    def _save(self, key, img):
+        if self.disk_dir is None or img.mode not in _PNG_MODES:
+            return
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        # write then rename, so readers never see partial files
+        fd, tmp = tempfile.mkstemp(suffix='.png', dir=self.disk_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                img.save(f, 'PNG', compress_level=1)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def clear(self):
+        """ Empty the memory tier. The disk tier is left alone. """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """ dict of hits, disk_hits, misses, evictions, entries and bytes
+        in memory.
+        """
+        with self._lock:
+            return {'hits': self._hits,
+                    'disk_hits': self._disk_hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_resize_cache():
+    """ Process-wide ResizeCache, used by `cache=True` in resizing
+    functions. Created on first use with default settings.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResizeCache()
+    return _default_cache
+
+
+def _resolve(cache):
+    """ ResizeCache for a `cache` argument: None, True or a ResizeCache """
+    if cache is True:
+        return get_resize_cache()
+    if cache is False:
+        return None
+    return cache
@@ -0,0 +1,457 @@
+
+__all__ = ['LiveMontage',
+           'MontageLayout',
+           'iter_montage_bands',
+           'render_montage',
+           'write_montage']
+
+
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import math
+import os
+
+import numpy as np
+from PIL import Image
+
+from .np_pil_interop import new_shared_image
+from .pil_utils import _default_color
+from .pil_utils import letterbox_resize
+
+
+# modes rendered on a canvas backed by an ndarray
+_ARRAY_MODES = ('L', 'RGB', 'RGBA')
+# modes PIL stores as the ndarray itself. RGB is not one of them: its
+# shared canvas is RGBX, which would need a converted copy to return.
+_SHARED_CANVAS_MODES = ('L', 'RGBA')
+
+
+class MontageLayout(object):
+    """ Position of every tile in a montage, computed once.
+
+    Tiles are placed row by row. If neither `ncols` nor `nrows` is
+    given, the grid is as square as possible in terms of (rows, cols).
+
+    :parameters:
+        - num_tiles: int
+        - tile_wh: tuple(int, int)
+            size of each tile
+        - ncols: int
+        - nrows: int
+        - margins_ltrb: tuple(int, int, int, int)
+            margins for montage; left, top, right, bottom
+        - padding: int
+            padding between tiles
+
+    >>> layout = MontageLayout(5, (128, 64))
+    >>> layout.ncols, layout.nrows, layout.size
+    (2, 3, (256, 192))
+    >>> layout.box(3)
+    (128, 64, 256, 128)
+    >>> MontageLayout(4, (10, 10), ncols=4, padding=1,
+    ...               margins_ltrb=(2, 2, 2, 2)).size
+    (47, 14)
+    """
+
+    def __init__(self, num_tiles, tile_wh, ncols=None, nrows=None,
+                 margins_ltrb=(0, 0, 0, 0), padding=0):
+        if ncols is None and nrows is None:
+            ncols = max(1, int(round(np.sqrt(num_tiles))))
+        if ncols is None:
+            ncols = max(1, int(math.ceil(float(num_tiles)/nrows)))
+        if nrows is None:
+            nrows = max(1, int(math.ceil(float(num_tiles)/ncols)))
+        self.num_tiles = min(num_tiles, nrows*ncols)
+        self.ncols, self.nrows = ncols, nrows
+        self.tile_wh = tuple(tile_wh)
+        self.margins_ltrb = tuple(margins_ltrb)
+        self.padding = padding
+
+        imgw, imgh = self.tile_wh
+        marl, mart, marr, marb = self.margins_ltrb
+        self.size = (ncols*imgw + marl + marr + (ncols-1)*padding,
+                     nrows*imgh + mart + marb + (nrows-1)*padding)
+
+        idx = np.arange(self.num_tiles)
+        self.lefts = marl + (idx % ncols)*(imgw + padding)
+        self.tops = mart + (idx // ncols)*(imgh + padding)
+
+    def box(self, i):
+        """ (left, upper, right, lower) of tile i """
+        left, top = int(self.lefts[i]), int(self.tops[i])
+        return (left, top, left+self.tile_wh[0], top+self.tile_wh[1])
+
+    def row_tiles(self, irow):
+        """ range of tile indices in row irow """
+        start = irow*self.ncols
+        return range(start, min(start+self.ncols, self.num_tiles))
+
+
+def _draw_borders(arr, layout, rows, px, color, y0=0):
+    """ Draw a `px` wide border inside every tile of the given rows,
+    with a few slice assignments per row of tiles. `arr` starts at
+    row `y0` of the montage.
+    """
+    imgw, imgh = layout.tile_wh
+    px = min(px, imgw, imgh)
+    offsets_w = np.concatenate([np.arange(px), imgw-px+np.arange(px)])
+    for irow in rows:
+        tiles = layout.row_tiles(irow)
+        if not len(tiles):
+            continue
+        top = int(layout.tops[tiles[0]]) - y0
+        x0, x1 = int(layout.lefts[tiles[0]]), layout.box(tiles[-1])[2]
+        if layout.padding == 0:
+            spans = [(x0, x1)]
+        else:
+            spans = [layout.box(i)[0::2] for i in tiles]
+        for left, right in spans:
+            arr[top:top+px, left:right] = color
+            arr[top+imgh-px:top+imgh, left:right] = color
+        cols = (layout.lefts[list(tiles)][:, None] + offsets_w).ravel()
+        arr[top:top+imgh, cols] = color
+
+
+def _paste_borders(canvas, layout, px, color):
+    """ Same as `_draw_borders`, for all rows, pasting `color` into
+    boxes of a PIL canvas.
+    """
+    imgw, imgh = layout.tile_wh
+    px = min(px, imgw, imgh)
+    for irow in range(layout.nrows):
+        tiles = layout.row_tiles(irow)
+        if not len(tiles):
+            continue
+        top = int(layout.tops[tiles[0]])
+        if layout.padding == 0:
+            spans = [(layout.box(tiles[0])[0], layout.box(tiles[-1])[2])]
+        else:
+            spans = [layout.box(i)[0::2] for i in tiles]
+        for left, right in spans:
+            canvas.paste(color, (left, top, right, top+px))
+            canvas.paste(color, (left, top+imgh-px, right, top+imgh))
+        for i in tiles:
+            left, _, right, _ = layout.box(i)
+            canvas.paste(color, (left, top, left+px, top+imgh))
+            canvas.paste(color, (right-px, top, right, top+imgh))
+
+
+def _montage_colors(mode, bg, border_color, resize_mode):
+    if resize_mode not in ('center', 'none'):
+        raise ValueError('unknown resize_mode')
+    if bg is None:
+        bg = _default_color(mode, 0)
+    if border_color is None:
+        border_color = _default_color(mode, 20)
+    return bg, border_color
+
+
+def _fit_tile(img, layout, resize_mode, bg):
+    if resize_mode == 'center' and img.size != layout.tile_wh:
+        img = letterbox_resize(img, layout.tile_wh, bg)
+    return img
+
+
+def render_montage(images, layout, mode=None, bg=None, resize_mode='none',
+                   border=0, border_color=None, num_threads=None):
+    """ Render images into a montage, in one preallocated canvas.
+
+    Tiles are resized (if needed) and written into the canvas in parallel
+    threads; borders are then drawn in bulk, on the canvas array for
+    modes L and RGBA, and with one paste per edge for other modes.
+
+    :parameters:
+        - images: sequence of PIL images
+        - layout: MontageLayout
+        - mode: mode of the montage. If None, mode of first image.
+        - bg: color of background
+        - resize_mode: string
+            how to fit images to the tile size. options: center, none.
+            with none, images are pasted as they are at the tile corner.
+        - border: int
+            width of border drawn inside each tile
+        - border_color: color of border
+        - num_threads: int
+            number of worker threads, defaults to number of cpus.
+
+    >>> imgs = [Image.new('L', (4, 4), 200) for _ in range(3)]
+    >>> m = render_montage(imgs, MontageLayout(3, (4, 4)), border=1,
+    ...                    border_color=20)
+    >>> m.size, m.getpixel((0, 0)), m.getpixel((1, 1)), m.getpixel((5, 5))
+    ((8, 8), 20, 200, 0)
+    """
+    images = list(images)[:layout.num_tiles]
+    if mode is None:
+        mode = images[0].mode
+    bg, border_color = _montage_colors(mode, bg, border_color, resize_mode)
+
+    if mode in _SHARED_CANVAS_MODES:
+        canvas, arr = new_shared_image(mode, layout.size)
+        arr[...] = bg
+    else:
+        canvas, arr = Image.new(mode, layout.size, bg), None
+
+    def work(i):
+        img = _fit_tile(images[i], layout, resize_mode, bg)
+        canvas.paste(img, layout.box(i)[:2])
+
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    if num_threads <= 1 or len(images) <= 1:
+        for i in range(len(images)):
+            work(i)
+    else:
+        with ThreadPoolExecutor(num_threads) as pool:
+            for _ in pool.map(work, range(len(images))):
+                pass
+
+    if border > 0 and arr is not None:
+        _draw_borders(arr, layout, range(layout.nrows), border,
+                      border_color)
+    elif border > 0:
+        _paste_borders(canvas, layout, border, border_color)
+    return canvas
+
+
+def iter_montage_bands(images, layout, mode='RGB', bg=None,
+                       resize_mode='center', border=0, border_color=None,
+                       num_threads=None):
+    """ Render a montage one row of tiles at a time.
+
+    Images are pulled lazily from `images`, one row of tiles at a time,
+    so peak memory is a single band and never the whole montage.
+    Bands together cover the montage from top to bottom, including
+    margins and padding.
+
+    :parameters:
+        - images: iterable of PIL images
+        - layout: MontageLayout
+        - mode: mode of the montage; one of L, RGB, RGBA
+        - bg: color of background
+        - resize_mode: string
+            how to fit images to the tile size. options: center, none.
+        - border: int
+            width of border drawn inside each tile
+        - border_color: color of border
+        - num_threads: int
+            number of worker threads, defaults to number of cpus.
+
+    :returns:
+        iterator over (top, band) pairs, band being an ndarray holding
+        montage rows [top, top+len(band)). Bands are backed by one reused
+        buffer, and are only valid until the next band is produced.
+
+    >>> imgs = (Image.new('L', (4, 4), 200) for _ in range(3))
+    >>> layout = MontageLayout(3, (4, 4), margins_ltrb=(0, 1, 0, 1))
+    >>> [(top, band.shape) for top, band in iter_montage_bands(
+    ...     imgs, layout, 'L')]
+    [(0, (5, 8)), (5, (5, 8))]
+    """
+    if mode not in _ARRAY_MODES:
+        raise ValueError('unsupported image mode')
+    bg, border_color = _montage_colors(mode, bg, border_color, resize_mode)
+
+    # band i spans from the top of tile row i (or 0) to the top of row i+1
+    w, h = layout.size
+    tops = [int(layout.tops[i*layout.ncols]) for i in range(layout.nrows)
+            if i*layout.ncols < layout.num_tiles]
+    edges = [0] + tops[1:] + [h]
+    band_h = max(b - a for a, b in zip(edges[:-1], edges[1:]))
+    canvas, arr = new_shared_image(mode, (w, band_h))
+
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    images = iter(images)
+    with ThreadPoolExecutor(num_threads) as pool:
+        for irow, (y0, y1) in enumerate(zip(edges[:-1], edges[1:])):
+            arr[...] = bg
+            tiles = layout.row_tiles(irow)
+            row_images = list(itertools.islice(images, len(tiles)))
+
+            def work(args):
+                i, img = args
+                left, top = layout.box(i)[:2]
+                img = _fit_tile(img, layout, resize_mode, bg)
+                canvas.paste(img, (left, top - y0))
+
+            for _ in pool.map(work, zip(tiles, row_images)):
+                pass
+            if border > 0:
+                _draw_borders(arr, layout, [irow], border, border_color, y0)
+            yield y0, arr[:y1-y0]
+
+
+def write_montage(images, layout, out, mode='RGB', bg=None,
+                  resize_mode='center', border=0, border_color=None,
+                  num_threads=None):
+    """ Write a montage to disk, band by band, without ever holding the
+    whole montage in memory. See `iter_montage_bands`.
+
+    :parameters:
+        - images: iterable of PIL images
+        - layout: MontageLayout
+        - out: where to write the montage. One of
+            - path ending in .npy: HxW(xC) memmap, which is returned
+            - path ending in .pgm or .ppm: binary netpbm image
+              (modes L and RGB), readable by PIL
+            - ndarray or np.memmap of the montage shape
+        - mode: mode of the montage; one of L, RGB, RGBA
+        - other parameters as in `iter_montage_bands`
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'sheet.ppm')
+    >>> imgs = (Image.new('RGB', (4, 4), (200, 0, 0)) for _ in range(3))
+    >>> _ = write_montage(imgs, MontageLayout(3, (4, 4)), path)
+    >>> m = Image.open(path)
+    >>> m.size, m.getpixel((5, 1)), m.getpixel((5, 5))
+    ((8, 8), (200, 0, 0), (0, 0, 0))
+    """
+    w, h = layout.size
+    channels = {'L': 1, 'RGB': 3, 'RGBA': 4}[mode]
+    shape = (h, w) if channels == 1 else (h, w, channels)
+    bands = iter_montage_bands(images, layout, mode, bg, resize_mode,
+                               border, border_color, num_threads)
+
+    if isinstance(out, np.ndarray) or out.endswith('.npy'):
+        if not isinstance(out, np.ndarray):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype='u1',
+                                            shape=shape)
+        elif out.shape != shape:
+            raise ValueError('out must have shape {}'.format(shape))
+        for top, band in bands:
+            out[top:top+len(band)] = band
+        if hasattr(out, 'flush'):
+            out.flush()
+        return out
+
+    if out.endswith('.pgm') or out.endswith('.ppm'):
+        if mode not in ('L', 'RGB'):
+            raise ValueError('netpbm output needs mode L or RGB')
+        magic = b'P5' if mode == 'L' else b'P6'
+        with open(out, 'wb') as f:
+            f.write(magic + '\n{} {}\n255\n'.format(w, h).encode('ascii'))
+            for top, band in bands:
+                f.write(np.ascontiguousarray(band).tobytes())
+        return out
+    raise ValueError('unknown output format')
+
+
+class LiveMontage(object):
+    """ Montage that keeps its canvas, for redrawing only changed tiles.
+
+    Replacing a tile redraws just its cell, and records the cell as a
+    dirty rectangle, so callers can re-encode or transmit only the
+    regions that changed. The whole canvas starts out dirty.
+
+    :parameters:
+        - layout: MontageLayout
+        - mode: mode of the montage; one of L, RGB, RGBA
+        - bg: color of background
+        - resize_mode: string
+            how to fit images to the tile size. options: center, none.
+        - border: int
+            width of border drawn inside each tile
+        - border_color: color of border
+
+    >>> live = LiveMontage(MontageLayout(4, (8, 8)), 'L')
+    >>> live.pop_dirty()
+    [(0, 0, 16, 16)]
+    >>> live.update({1: Image.new('L', (8, 8), 255)})
+    [(8, 0, 16, 8)]
+    >>> live.image.getpixel((9, 1)), live.image.getpixel((1, 1))
+    (255, 0)
+    >>> live.pop_dirty(), live.pop_dirty()
+    ([(8, 0, 16, 8)], [])
+    >>> live = LiveMontage(MontageLayout(1, (8, 8)), 'L', bg=100,
+    ...                    resize_mode='none')
+    >>> _ = live.set_tile(0, Image.new('L', (4, 4), 255))
+    >>> live.image.getpixel((2, 2)), live.image.getpixel((6, 6))
+    (255, 100)
+    """
+
+    def __init__(self, layout, mode='RGB', bg=None, resize_mode='center',
+                 border=0, border_color=None):
+        if mode not in _ARRAY_MODES:
+            raise ValueError('unsupported image mode')
+        self.layout = layout
+        self.mode = mode
+        self.resize_mode = resize_mode
+        self.border = border
+        self.bg, self.border_color = _montage_colors(mode, bg, border_color,
+                                                     resize_mode)
+        self._canvas, self.array = new_shared_image(mode, layout.size)
+        self.array[...] = self.bg
+        self._dirty = [(0, 0) + layout.size]
+
+    @property
+    def image(self):
+        """ The montage. For L and RGBA this is the live canvas itself;
+        for RGB, a copy.
+        """
+        if self.mode == 'RGB':
+            return self._canvas.convert('RGB')
+        return self._canvas
+
+    def region(self, box):
+        """ copy of one region of the montage, e.g. a dirty rectangle """
+        region = self._canvas.crop(box)
+        if self.mode == 'RGB':
+            return region.convert('RGB')
+        return region
+
+    def set_tile(self, i, img):
+        """ Replace tile i, redrawing only its cell.
+        Returns the cell box (left, upper, right, lower).
+        """
+        if not 0 <= i < self.layout.num_tiles:
+            raise IndexError('tile index out of range')
+        box = self.layout.box(i)
+        left, top, right, lower = box
+        cell = self.array[top:lower, left:right]
+        cell[...] = self.bg
+        if img is not None:
+            img = _fit_tile(img, self.layout, self.resize_mode, self.bg)
+            cw, ch = right-left, lower-top
+            if img.size[0] > cw or img.size[1] > ch:
+                # crop padding would cover the background with zeros
+                img = img.crop((0, 0, min(img.size[0], cw),
+                                min(img.size[1], ch)))
+            self._canvas.paste(img, (left, top))
+        if self.border > 0:
+            px = min(self.border, right-left, lower-top)
+            cell[:px] = self.border_color
+            cell[-px:] = self.border_color
+            cell[:, :px] = self.border_color
+            cell[:, -px:] = self.border_color
+        if box not in self._dirty:
+            self._dirty.append(box)
+        return box
+
+    def update(self, tiles):
+        """ Replace several tiles.
+
+        :parameters:
+            - tiles: dict of index -> image, or iterable of
+              (index, image) pairs. An image of None clears the tile.
+
+        :returns:
+            list of redrawn cell boxes
+        """
+        if isinstance(tiles, dict):
+            tiles = tiles.items()
+        return [self.set_tile(i, img) for i, img in tiles]
+
+    def pop_dirty(self):
+        """ Dirty rectangles since the last call, as (left, upper, right,
+        lower) boxes.
+        """
+        dirty, self._dirty = self._dirty, []
+        return dirty
+
+
+# relative imports need the package: python -m imgutils.compositing
+if __name__ == '__main__':
+    import doctest
+    flags = doctest.REPORT_NDIFF
+    fail, total = doctest.testmod(optionflags=flags)
+    print("{} failures out of {} tests".format(fail, total))
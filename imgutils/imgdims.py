@@ -33,6 +33,8 @@ class ImgDims(object):
     >>> d.cols
     320
     >>> d/2
+    ImgDims(width=160.0, height=120.0)
+    >>> (d/2).round()
     ImgDims(width=160, height=120)
     >>> df = ImgDims(width=320.3, height=239.8)
     >>> df.round()
@@ -112,6 +114,9 @@ class ImgDims(object):
         self.height /= other
         return self
 
+    __truediv__ = __div__
+    __itruediv__ = __idiv__
+
     def __eq__(self, other):
         return other.width == self.width and other.height == self.height
 
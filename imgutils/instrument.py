@@ -0,0 +1,261 @@
+
+"""Opt-in instrumentation of the public imgutils functions.
+
+When enabled, each public function is replaced in its module (and in
+the ``imgutils`` namespace) by a wrapper that records, per function,
+the number of calls, wall time, pixels of the first argument and bytes
+of the returned images/arrays. Disabling restores the original
+functions, so instrumentation costs nothing when it is off.
+
+Functions bound by name outside imgutils before `enable` was called,
+e.g. with ``from imgutils import smart_resize``, keep pointing to the
+original function. Names imgutils submodules import from each other
+are patched too, so calls between imgutils functions are counted, and
+e.g. `square_montage` time includes its `letterbox_resize` calls. For
+functions returning iterators, only the call itself is timed.
+
+>>> import imgutils
+>>> from imgutils import instrument
+>>> from PIL import Image
+>>> seen = []
+>>> def record(name, *metrics):
+...     seen.append(name)
+>>> with instrument.instrumented(callback=record):
+...     _ = imgutils.smart_resize(Image.new('RGB', (64, 32)), (16, None))
+>>> s = instrument.get_stats()['smart_resize']
+>>> s['calls'], s['pixels'], s['out_bytes'], seen
+(1, 2048, 384, ['smart_resize'])
+>>> instrument.reset_stats()
+"""
+
+__all__ = ['add_callback',
+           'disable',
+           'enable',
+           'get_stats',
+           'instrumented',
+           'is_enabled',
+           'remove_callback',
+           'reset_stats']
+
+
+from contextlib import contextmanager
+import functools
+import importlib
+import sys
+import threading
+import time
+
+
+_lock = threading.Lock()
+_stats = {}
+_callbacks = []
+# (module, name, original function) of every patched attribute
+_patched = []
+
+# bytes per band of PIL modes that are not 8 bits
+_BAND_BYTES = {'I': 4, 'F': 4, 'I;16': 2, 'I;16B': 2, 'I;16L': 2}
+
+
+class _FuncStats(object):
+
+    __slots__ = ('calls', 'seconds', 'pixels', 'out_bytes')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.
+        self.pixels = 0
+        self.out_bytes = 0
+
+    def as_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+
+def _is_array(obj):
+    return hasattr(obj, 'shape') and hasattr(obj, 'nbytes')
+
+
+def _is_image(obj):
+    return isinstance(getattr(obj, 'mode', None), str) and \
+        isinstance(getattr(obj, 'size', None), tuple)
+
+
+def _count_pixels(obj):
+    """ pixels of an image, array or list/tuple of them. For arrays the
+    last axis is taken as channels when it is at most 4 long.
+    """
+    if _is_image(obj):
+        return obj.size[0]*obj.size[1]
+    if _is_array(obj):
+        if obj.ndim < 2:
+            return 0
+        if obj.ndim >= 3 and obj.shape[-1] <= 4:
+            return obj.size // max(obj.shape[-1], 1)
+        return obj.size
+    if isinstance(obj, (list, tuple)):
+        return sum(_count_pixels(x) for x in obj)
+    return 0
+
+
+def _count_bytes(obj):
+    """ bytes of the images/arrays in a result """
+    if _is_image(obj):
+        band = _BAND_BYTES.get(obj.mode, 1)
+        return obj.size[0]*obj.size[1]*len(obj.getbands())*band
+    if _is_array(obj):
+        return obj.nbytes
+    if isinstance(obj, (list, tuple)):
+        return sum(_count_bytes(x) for x in obj)
+    return 0
+
+
+def _record(name, seconds, pixels, out_bytes):
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = _FuncStats()
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.pixels += pixels
+        stats.out_bytes += out_bytes
+        callbacks = list(_callbacks)
+    for callback in callbacks:
+        callback(name, seconds, pixels, out_bytes)
+
+
+def _wrap(name, func):
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        finally:
+            seconds = time.perf_counter() - t0
+            pixels = _count_pixels(args[0]) if args else 0
+            out = kwargs.get('out')
+            # results written into a caller's buffer allocate nothing
+            out_bytes = 0 if out is not None and result is out else \
+                _count_bytes(result)
+            _record(name, seconds, pixels, out_bytes)
+
+    wrapper._imgutils_instrumented = True
+    return wrapper
+
+
+def _public_functions(names=None):
+    """ yield (module, name, function) of public imgutils functions """
+    package = sys.modules[__name__.rpartition('.')[0]]
+    for module_name, public in sorted(package._SUBMODULE_NAMES.items()):
+        for name in public:
+            if names is not None and name not in names:
+                continue
+            module = importlib.import_module('.' + module_name,
+                                             package.__name__)
+            func = getattr(module, name)
+            if isinstance(func, type) or not callable(func):
+                continue
+            yield module, name, func
+
+
+def enable(names=None, callback=None):
+    """ Start recording stats of the public imgutils functions.
+
+    :parameters:
+        - names: optional list of function names to instrument, default
+          is all of them.
+        - callback: optional function, added with `add_callback`. It
+          stays registered until `remove_callback`.
+    """
+    if callback is not None:
+        add_callback(callback)
+    with _lock:
+        wrappers = {}
+        for module, name, func in _public_functions(names):
+            if getattr(func, '_imgutils_instrumented', False):
+                continue
+            wrappers[id(func)] = (func, _wrap(name, func))
+        # the defining module, and any other holding the same function:
+        # submodules importing it by name, and the package namespace,
+        # which caches names looked up through it
+        for module in _modules():
+            for name, value in list(vars(module).items()):
+                func, wrapper = wrappers.get(id(value), (None, None))
+                if func is value:
+                    _patched.append((module, name, func))
+                    setattr(module, name, wrapper)
+
+
+def _modules():
+    """ the imgutils package and its imported submodules """
+    package_name = __name__.rpartition('.')[0]
+    return [module for name, module in list(sys.modules.items())
+            if module is not None and (name == package_name or
+                                       name.startswith(package_name + '.'))]
+
+
+def disable():
+    """ Restore the original functions. Stats and callbacks are kept. """
+    with _lock:
+        while _patched:
+            module, name, func = _patched.pop()
+            setattr(module, name, func)
+        # wrappers bound while enabled: names first looked up through the
+        # package, cached by its __getattr__, and names imported by
+        # submodules loaded in the meantime
+        for module in _modules():
+            for name, value in list(vars(module).items()):
+                if getattr(value, '_imgutils_instrumented', False):
+                    setattr(module, name, value.__wrapped__)
+
+
+def is_enabled():
+    return bool(_patched)
+
+
+@contextmanager
+def instrumented(names=None, callback=None):
+    """ Context manager enabling instrumentation for its body.
+
+    Yields a function returning the stats so far, like `get_stats`.
+    """
+    enable(names)
+    if callback is not None:
+        add_callback(callback)
+    try:
+        yield get_stats
+    finally:
+        disable()
+        if callback is not None:
+            remove_callback(callback)
+
+
+def add_callback(callback):
+    """ Call `callback(name, seconds, pixels, out_bytes)` after every
+    instrumented call, e.g. to forward metrics elsewhere. It runs in
+    the calling thread, so it should be quick.
+    """
+    with _lock:
+        _callbacks.append(callback)
+
+
+def remove_callback(callback):
+    with _lock:
+        _callbacks.remove(callback)
+
+
+def get_stats():
+    """ dict of function name to dict with calls, seconds, pixels and
+    out_bytes totals.
+    """
+    with _lock:
+        return dict((name, s.as_dict()) for name, s in _stats.items())
+
+
+def reset_stats():
+    """ Clear stats. Callbacks stay registered, so stats can be reset
+    periodically, e.g. after each flush, without unhooking them.
+    """
+    with _lock:
+        _stats.clear()
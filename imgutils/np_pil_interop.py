@@ -0,0 +1,255 @@
+
+__all__ = ['BufferPool',
+           'array_to_image',
+           'can_share_memory',
+           'image_to_array',
+           'new_shared_image']
+
+
+import threading
+
+import numpy as np
+from PIL import Image
+
+
+# modes PIL can map directly over an external buffer, with their dtype
+# and number of channels. other modes (notably 'RGB', which PIL stores
+# with 4 bytes per pixel) always need a copy.
+_SHARED_MODES = {
+    'L': ('u1', 1),
+    'P': ('u1', 1),
+    'RGBX': ('u1', 4),
+    'RGBA': ('u1', 4),
+    'CMYK': ('u1', 4),
+    'I;16': ('<u2', 1),
+}
+
+# mode inferred from dtype and number of channels of an array
+_ARRAY_MODES = [
+    ('u1', 1, 'L'),
+    ('u1', 3, 'RGB'),
+    ('u1', 4, 'RGBA'),
+    ('<u2', 1, 'I;16'),
+    ('<i4', 1, 'I'),
+    ('<f4', 1, 'F'),
+]
+
+
+def _channels(arr):
+    if arr.ndim == 2:
+        return 1
+    elif arr.ndim == 3:
+        return arr.shape[2]
+    raise ValueError('array must be HxW or HxWxC')
+
+
+def _array_mode(arr):
+    channels = _channels(arr)
+    for dtype, c, mode in _ARRAY_MODES:
+        if arr.dtype == np.dtype(dtype) and channels == c:
+            return mode
+    raise ValueError('no image mode for {} array with {} channels'.format(
+        arr.dtype, channels))
+
+
+def can_share_memory(arr, mode=None):
+    """ Whether `array_to_image` can wrap `arr` without copying.
+
+    True for C-contiguous arrays in modes L, P, RGBA, RGBX, CMYK and I;16.
+
+    >>> can_share_memory(np.zeros((4, 4), dtype='uint8'))
+    True
+    >>> can_share_memory(np.zeros((4, 4, 3), dtype='uint8'))
+    False
+    >>> can_share_memory(np.zeros((4, 8), dtype='uint8')[:, ::2])
+    False
+    """
+    if mode is None:
+        mode = _array_mode(arr)
+    if mode not in _SHARED_MODES:
+        return False
+    dtype, channels = _SHARED_MODES[mode]
+    return (arr.flags.c_contiguous and
+            arr.dtype == np.dtype(dtype) and
+            _channels(arr) == channels)
+
+
+def array_to_image(arr, mode=None, writable=False, allow_copy=True):
+    """ Convert ndarray to PIL image, sharing memory where possible.
+
+    The image is a view of `arr` when `can_share_memory(arr, mode)`.
+    Otherwise the data is copied, unless `allow_copy` is False,
+    in which case ValueError is raised.
+
+    A shared image is read-only by default: PIL will copy it before any
+    in-place operation (paste, ImageDraw, ...). With `writable`, in-place
+    operations write straight to `arr`.
+
+    :parameters:
+        - arr: HxW or HxWxC ndarray
+        - mode: PIL mode. Inferred from dtype and channels if None.
+        - writable: bool
+            let PIL write into `arr` through the image.
+        - allow_copy: bool
+            if False, raise instead of copying.
+
+    >>> arr = np.zeros((2, 3), dtype='uint8')
+    >>> img = array_to_image(arr, writable=True)
+    >>> img.size, img.mode
+    ((3, 2), 'L')
+    >>> img.paste(9, (0, 0, 1, 1))
+    >>> int(arr[0, 0])
+    9
+    >>> array_to_image(np.zeros((2, 3, 3), dtype='uint8'), allow_copy=False)
+    Traceback (most recent call last):
+        ...
+    ValueError: mode RGB array cannot be shared with PIL without a copy
+    """
+    if mode is None:
+        mode = _array_mode(arr)
+    h, w = arr.shape[:2]
+
+    if can_share_memory(arr, mode):
+        if writable and not arr.flags.writeable:
+            raise ValueError('array is not writeable')
+        img = Image.frombuffer(mode, (w, h), arr, 'raw', mode, 0, 1)
+        if writable:
+            img.readonly = 0
+        # remember the array, so image_to_array can return it again
+        img._imgutils_base = (img.im, arr)
+        return img
+
+    if not allow_copy:
+        raise ValueError(
+            'mode {} array cannot be shared with PIL without a copy'.format(
+                mode))
+    if writable:
+        raise ValueError('cannot write through a copied image')
+    return Image.frombytes(mode, (w, h), np.ascontiguousarray(arr))
+
+
+def image_to_array(img, out=None, writable=False, allow_copy=True):
+    """ Convert PIL image to ndarray, avoiding copies where possible.
+
+    Images created by `array_to_image` (or `new_shared_image`) without a
+    copy give back a view of the original array, read-only unless
+    `writable`. Other images are copied: into `out` if it is given,
+    which avoids any allocation for the modes PIL can share, or into a
+    new array otherwise. With `allow_copy` False, copying raises
+    ValueError instead.
+
+    :parameters:
+        - img: PIL image
+        - out: optional preallocated HxW or HxWxC array to copy into
+        - writable: bool
+            return a writeable view for shared images.
+        - allow_copy: bool
+            if False, raise instead of copying.
+
+    >>> arr = np.arange(6, dtype='uint8').reshape(2, 3)
+    >>> view = image_to_array(array_to_image(arr))
+    >>> np.shares_memory(view, arr), view.flags.writeable
+    (True, False)
+    >>> out = np.empty((2, 3), dtype='uint8')
+    >>> image_to_array(Image.new('L', (3, 2), 5), out=out) is out
+    True
+    >>> out[0]
+    array([5, 5, 5], dtype=uint8)
+    """
+    base = getattr(img, '_imgutils_base', None)
+    # the base is stale if PIL replaced the image memory (copy on write)
+    if base is not None and base[0] is img.im:
+        arr = base[1]
+        if out is None:
+            view = arr.view()
+            if not writable:
+                view.flags.writeable = False
+            return view
+        if out is arr:
+            return out
+
+    if not allow_copy:
+        raise ValueError('image memory cannot be shared without a copy')
+
+    if out is None:
+        return np.array(img)
+    if can_share_memory(out, img.mode):
+        # let PIL copy pixels straight into out
+        target = array_to_image(out, img.mode, writable=True)
+        target.paste(img, (0, 0))
+    else:
+        out[...] = np.asarray(img).reshape(out.shape)
+    return out
+
+
+def new_shared_image(mode, size, fill=0):
+    """ Allocate an image and an ndarray sharing the same memory.
+
+    Useful for reusing one buffer across frames: paste or draw into the
+    image and read the array, or write the array and hand the image
+    to PIL, without copies either way.
+    'RGB' images are backed by an 'RGBX' image, and the returned array
+    is a HxWx3 view of its HxWx4 buffer.
+
+    :parameters:
+        - mode: PIL mode, one of L, P, RGB, RGBX, RGBA, CMYK, I;16
+        - size: width, height
+        - fill: initial value for all array elements
+
+    >>> img, arr = new_shared_image('RGB', (3, 2))
+    >>> img.mode, arr.shape
+    ('RGBX', (2, 3, 3))
+    >>> img.paste(Image.new('RGB', (3, 2), (1, 2, 3)))
+    >>> arr[1, 2]
+    array([1, 2, 3], dtype=uint8)
+    """
+    w, h = size
+    img_mode = 'RGBX' if mode == 'RGB' else mode
+    if img_mode not in _SHARED_MODES:
+        raise ValueError('unsupported image mode')
+    dtype, channels = _SHARED_MODES[img_mode]
+    shape = (h, w) if channels == 1 else (h, w, channels)
+    arr = np.empty(shape, dtype=dtype)
+    arr.fill(fill)
+    img = array_to_image(arr, img_mode, writable=True)
+    if mode == 'RGB':
+        arr = arr[..., :3]
+    return img, arr
+
+
+class BufferPool(object):
+    """ Recycles ndarrays, so hot loops can reuse output buffers instead of
+    allocating new ones. Thread-safe.
+
+    :parameters:
+        - max_free: int
+            most released buffers kept per (shape, dtype).
+
+    >>> pool = BufferPool()
+    >>> a = pool.get((2, 3), 'float32')
+    >>> pool.release(a)
+    >>> pool.get((2, 3), 'float32') is a
+    True
+    """
+
+    def __init__(self, max_free=4):
+        self.max_free = max_free
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def get(self, shape, dtype):
+        """ a released buffer of this shape and dtype, or a new one """
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, arr):
+        """ give `arr` back to the pool; it must not be used afterwards """
+        key = (arr.shape, arr.dtype)
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            if len(free) < self.max_free:
+                free.append(arr)
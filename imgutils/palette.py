@@ -1,37 +1,214 @@
-from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+
 from PIL import Image
 import numpy as np
 
+from .np_pil_interop import array_to_image
+from .remapping import _compiled
+
+
+__all__ = ['Palette',
+           'add_color_palette',
+           'get_palette',
+           'save_palettized_pngs']
+
+
+class Palette(object):
+    """ Color palette for 8-bit label images, built once with numpy.
+
+    :parameters:
+        - `class_id_to_rgb`: dict or list.
+        Colors must be integers in (0, 255) range, and dict keys class
+        ids in (0, 255).
+        - `default`: color of ids missing from a dict, up to the largest
+        one.
+
+    >>> pal = Palette({0: (0, 0, 0), 2: (255, 0, 0)})
+    >>> pal.colors.tolist()
+    [[0, 0, 0], [0, 0, 0], [255, 0, 0]]
+    >>> img = pal.apply(np.array([[0, 2]], dtype='uint8'))
+    >>> img.mode, img.convert('RGB').getpixel((1, 0))
+    ('P', (255, 0, 0))
+    """
 
-__all__ = ['add_color_palette']
+    def __init__(self, class_id_to_rgb, default=(0, 0, 0)):
+        if isinstance(class_id_to_rgb, dict):
+            keys = np.array(list(class_id_to_rgb.keys()), dtype='int64')
+            values = np.array(list(class_id_to_rgb.values()),
+                              dtype='int64').reshape(-1, 3)
+            if len(keys) and (keys.min() < 0 or keys.max() > 255):
+                raise ValueError('class ids must be in (0, 255) range')
+            colors = np.empty((keys.max() + 1 if len(keys) else 0, 3),
+                              dtype='int64')
+            colors[...] = default
+            colors[keys] = values
+        else:
+            colors = np.array(class_id_to_rgb, dtype='int64').reshape(-1, 3)
+        if colors.size and (colors.min() < 0 or colors.max() > 255):
+            raise ValueError('colors must be in (0, 255) range')
+        self.colors = colors.astype('uint8')
+        self._flat = self.colors.ravel().tolist()
+
+    @property
+    def nbytes(self):
+        return self.colors.nbytes
+
+    def __len__(self):
+        return len(self.colors)
+
+    def apply(self, img, copy=True):
+        """ Add the palette to an 8-bit image.
+
+        PIL images (L or P) get the palette in-place and are returned.
+        2D arrays are converted to a new P image, which shares memory
+        with the array if `copy` is False.
+        """
+        if not isinstance(img, Image.Image):
+            img = np.asarray(img)
+            if img.ndim != 2:
+                raise ValueError('Invalid image shape {}, should be '
+                                 '2D'.format(img.shape))
+            if img.dtype != np.uint8:
+                if img.size and (img.min() < 0 or img.max() > 255):
+                    raise ValueError('labels must be in (0, 255) range')
+                # already a new array
+                img = img.astype('uint8')
+                copy = False
+            if copy:
+                # an L image, which putpalette turns into P
+                img = Image.fromarray(img)
+            else:
+                img = array_to_image(np.ascontiguousarray(img), mode='P')
+        elif img.mode not in ('L', 'P'):
+            raise ValueError('Invalid image mode ({})'.format(img.mode))
+        img.putpalette(self._flat)
+        return img
+
+    def save(self, img, fp, compress_level=6, optimize=False, **kwargs):
+        """ Save an 8-bit image or 2D array as a palettized PNG.
+
+        :parameters:
+            - img: PIL image or 2D array of class ids
+            - fp: path or file object
+            - compress_level: int
+                zlib level, 0 (fastest, biggest) to 9. 1 is usually
+                several times faster than PIL's default of 6, for files
+                somewhat bigger.
+            - optimize: bool
+                extra encoder pass for smaller files, slow.
+            - kwargs: other PNG options for `Image.save`
+        """
+        if isinstance(img, Image.Image):
+            img = img.copy()
+        self.apply(img, copy=False).save(fp, 'PNG',
+                                         compress_level=compress_level,
+                                         optimize=optimize, **kwargs)
+
+
+def get_palette(class_id_to_rgb):
+    """ Palette for a dict or list, shared between calls with an equal
+    mapping.
+    """
+    return _compiled(Palette, class_id_to_rgb)
 
 
 def add_color_palette(img, class_id_to_rgb):
     """ Add color palette to 8-bit PIL image.
 
     :parameters:
-        - `class_id_to_rgb`: dict or list.
+        - `class_id_to_rgb`: dict, list or Palette.
         Colors must be integers in (0, 255) range.
+
+    >>> img = add_color_palette(np.zeros((2, 2), dtype='uint8'),
+    ...                         {1: (0, 255, 0)})
+    >>> img.getpalette()[:6]
+    [0, 0, 0, 0, 255, 0]
+    """
+    return get_palette(class_id_to_rgb).apply(img)
+
+
+# palette and encoder settings of each worker, set by _init_worker
+_worker = {}
+
+
+def _init_worker(palette, save_kwargs):
+    _worker.update(palette=palette, save_kwargs=save_kwargs)
+
+
+def _save_one(label, path):
+    if not isinstance(label, np.ndarray):
+        # .npy path, read in the worker instead of pickling pixels
+        label = np.load(label, mmap_mode='r')
+    _worker['palette'].save(label, path, **_worker['save_kwargs'])
+    return path
+
+
+def save_palettized_pngs(labels, paths, class_id_to_rgb, num_workers=None,
+                         max_in_flight=None, mp_context=None, **save_kwargs):
+    """ Save many label images as palettized PNGs, in worker processes.
+
+    :parameters:
+        - labels: iterable of 2D uint8 arrays, or of paths of .npy files
+            holding them, which are then loaded by the workers.
+        - paths: iterable of output paths, one per label image
+        - class_id_to_rgb: dict, list or Palette
+        - num_workers: int
+            worker processes, defaults to number of cpus. 0 saves in
+            this process.
+        - max_in_flight: int
+            most images queued at once, default is 4*num_workers.
+            Bounds the memory used by arrays waiting to be pickled.
+        - mp_context: optional multiprocessing context for the pool
+        - save_kwargs: encoder settings for `Palette.save`, e.g.
+            compress_level=1
+
+    :returns:
+        number of images saved.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> labels = [np.full((4, 4), i, dtype='uint8') for i in range(3)]
+    >>> paths = [os.path.join(d, '{}.png'.format(i)) for i in range(3)]
+    >>> save_palettized_pngs(labels, paths, [(0, 0, 0), (9, 9, 9)] * 2,
+    ...                      num_workers=2, compress_level=1)
+    3
+    >>> Image.open(paths[1]).convert('RGB').getpixel((0, 0))
+    (9, 9, 9)
     """
-    if not isinstance(img, Image.Image):
-        img = Image.fromarray(img)
-        if img.mode == 'RGB':
-            raise ValueError('Invalid image mode (RGB)')
-
-    if (isinstance(class_id_to_rgb, dict) or
-        isinstance(class_id_to_rgb, OrderedDict)):
-        class_id_to_rgb_lst = []
-        keys = sorted(class_id_to_rgb.keys())
-        max_key = np.max(keys)
-        for k in xrange(max_key+1):
-            rgb = class_id_to_rgb.get(k, (0, 0, 0))
-            class_id_to_rgb_lst.append(rgb)
-    else:
-        class_id_to_rgb_lst = class_id_to_rgb
-
-    class_id_to_rgb_lst_flat = []
-    for rgb in class_id_to_rgb_lst:
-        class_id_to_rgb_lst_flat.extend(list(rgb))
-
-    img.putpalette(class_id_to_rgb_lst_flat)
-    return img
+    palette = get_palette(class_id_to_rgb)
+    if num_workers == 0:
+        _init_worker(palette, save_kwargs)
+        count = 0
+        for label, path in zip(labels, paths):
+            _save_one(label, path)
+            count += 1
+        return count
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 4*num_workers
+    count = 0
+    with ProcessPoolExecutor(num_workers, mp_context=mp_context,
+                             initializer=_init_worker,
+                             initargs=(palette, save_kwargs)) as pool:
+        pending = deque()
+        for label, path in zip(labels, paths):
+            pending.append(pool.submit(_save_one, label, path))
+            if len(pending) >= max_in_flight:
+                pending.popleft().result()
+                count += 1
+        for future in pending:
+            future.result()
+            count += 1
+    return count
+
+
+# relative imports need the package: python -m imgutils.palette
+if __name__ == '__main__':
+    import doctest
+    flags = doctest.REPORT_NDIFF
+    fail, total = doctest.testmod(optionflags=flags)
+    print("{} failures out of {} tests".format(fail, total))
@@ -3,29 +3,44 @@ from __future__ import print_function
 
 __all__ = [
     'add_border',
+    'center_box',
     'crop_center',
+    'crop_resize',
     'draw_bbox',
+    'draw_bboxes',
     'dstack_rgb',
     'hstack',
     'images_to_tensor4',
     'tensor4_to_images',
+    'Tensor4Images',
     'letterbox_resize',
+    'letterbox_resize_file',
     'montage',
     'smart_resize',
+    'smart_resize_file',
     'square_montage',
+    'trim_box',
     'trim_percentage',
     'vstack',
 ]
 
 
+from concurrent.futures import ThreadPoolExecutor
 import math
+import os
+import threading
 
 import numpy as np
 from PIL import Image
 from PIL import ImageDraw
-from PIL import ImageFont
 from PIL import ImageOps
 
+from .np_pil_interop import BufferPool
+from .np_pil_interop import array_to_image
+from .np_pil_interop import can_share_memory
+from .np_pil_interop import image_to_array
+from .np_pil_interop import new_shared_image
+
 
 def _default_color(mode, c, transparent=False):
     if mode == 'L':
@@ -44,7 +59,8 @@ def _all_equal(seq):
     return True
 
 
-def letterbox_resize(img, img_wh, bg=None, interp=None):
+def letterbox_resize(img, img_wh, bg=None, interp=None, cache=None,
+                     reducing_gap=2.0):
     """
     Use PIL thumbnail to resize. May letterbox output in
     order to keep aspect ratio.
@@ -56,6 +72,13 @@ def letterbox_resize(img, img_wh, bg=None, interp=None):
            Color for background as rgb int tuple
         - `interp`: int
            Interpolation code from PIL.Image
+        - `cache`: ResizeCache, or True for the shared one from
+           `get_resize_cache`. Results for identical images and
+           parameters are returned from the cache without resampling.
+        - `reducing_gap`: float or None
+           Shrink by an integer factor with a box filter first, while
+           staying at least this many times the output size, then
+           resample. See `smart_resize`. None resamples in one pass.
 
     >>> img = Image.new('L', (128, 128))
     >>> imgr = letterbox_resize(img, (20, 20))
@@ -69,34 +92,70 @@ def letterbox_resize(img, img_wh, bg=None, interp=None):
     (200, 200)
     """
 
-    w, h = img_wh
-    if bg is None:
-        bg = _default_color(img.mode, 0, transparent=False)
+    if cache is not None:
+        from .cache import _resolve
+        cache = _resolve(cache)
+    if cache is not None:
+        return cache.get_or_compute(
+            'letterbox_resize', img, (tuple(img_wh), bg, interp,
+                                      reducing_gap),
+            lambda: letterbox_resize(img, img_wh, bg, interp,
+                                     reducing_gap=reducing_gap))
 
-    if interp is None:
-        if img.size[0] >= w or img.size[1] >= h:
-            interp = Image.ANTIALIAS
-        else:
-            interp = Image.BICUBIC
+    return crop_resize(img, None, img_wh, letterbox=True, bg=bg,
+                       interp=interp, reducing_gap=reducing_gap)
+
+
+def _default_interp(src_wh, dst_wh):
+    if src_wh[0] >= dst_wh[0] or src_wh[1] >= dst_wh[1]:
+        return Image.LANCZOS
+    return Image.BICUBIC
 
-    img = img.copy()
-    img.thumbnail((w, h), interp)
-    newimg = Image.new(img.mode, (w, h), bg)
-    left = int(math.floor((newimg.size[0]-img.size[0])*.5))
-    top = int(math.floor((newimg.size[1]-img.size[1])*.5))
-    newimg.paste(img, (left, top))
-    return newimg
+
+def _letterbox_paste(img, img_wh, bg, out=None):
+    """ paste img centered on a new img_wh canvas of color bg, or on
+    `out`, clearing only its margins.
+    """
+    if bg is None:
+        bg = _default_color(img.mode, 0, transparent=False)
+    w, h = img_wh
+    left = int(math.floor((w-img.size[0])*.5))
+    top = int(math.floor((h-img.size[1])*.5))
+    right, bottom = left + img.size[0], top + img.size[1]
+    if out is None:
+        out = Image.new(img.mode, img_wh, bg)
+    else:
+        for margin in ((0, 0, w, top), (0, bottom, w, h),
+                       (0, top, left, bottom), (right, top, w, bottom)):
+            if margin[0] < margin[2] and margin[1] < margin[3]:
+                out.paste(bg, margin)
+    out.paste(img, (left, top))
+    return out
 
 
-def smart_resize(img, img_wh, interp=None):
+def smart_resize(img, img_wh, interp=None, cache=None, reducing_gap=None):
     """
     adjusts either w or h, depending on which is None (or <= 0)
 
+    With `reducing_gap` set, big downscales run in two stages: an
+    integer factor box reduction (`Image.reduce`) down to at least
+    `reducing_gap` times the output size, then the final resample on the
+    small image. Resizing a 1920x1080 RGB image to 224 wide, 2.0 takes
+    about 5 ms instead of 24 ms, at ~43 dB PSNR against the one pass
+    result, and an 8K image about 32 ms instead of 330 ms. 3.0 gets
+    ~52 dB at up to half the speed of 2.0; 1.0 is fastest but leaves
+    visible aliasing on fine textures. `letterbox_resize` uses 2.0 by
+    default. The `resize_reducing_gap` cases of the benchmark suite
+    measure both time and PSNR.
+
     :parameters:
         - img: input Image
         - img_wh: desired width, height
         - interp: int
             interpolation code from PIL.Image
+        - cache: ResizeCache or True, as in `letterbox_resize`
+        - reducing_gap: float or None
+            None (default) resamples the full image in one pass.
 
     >>> img = Image.new('L', (128, 128))
     >>> imgr = smart_resize(img, (None, 256))
@@ -110,27 +169,104 @@ def smart_resize(img, img_wh, interp=None):
     (512, 512)
     """
 
+    if cache is not None:
+        from .cache import _resolve
+        cache = _resolve(cache)
+    if cache is not None:
+        return cache.get_or_compute(
+            'smart_resize', img, (tuple(img_wh), interp, reducing_gap),
+            lambda: smart_resize(img, img_wh, interp,
+                                 reducing_gap=reducing_gap))
+
+    w, h = _smart_size(img.size, img_wh)
+    if interp is None:
+        interp = _default_interp(img.size, (w, h))
+    img = img.resize((w, h), interp, reducing_gap=reducing_gap)
+    return img
+
+
+def _smart_size(src_wh, img_wh):
+    """ img_wh with the missing (None or <= 0) side filled in from the
+    aspect ratio of src_wh.
+    """
     w, h = img_wh
     is_valid = lambda x: (x is not None) and (x > 0)
     if not is_valid(w) and not is_valid(h):
         raise ValueError("One of width or height must be specified")
-
-    old_w, old_h = img.size
-    ratio = float(old_w)/old_h
+    ratio = float(src_wh[0])/src_wh[1]
     if not is_valid(h):
         h = int(w/ratio)
     elif not is_valid(w):
         w = int(h*ratio)
+    return w, h
 
-    if interp is None:
-        if old_w >= w or old_h >= h:
-            interp = Image.ANTIALIAS
-        else:
-            interp = Image.BICUBIC
 
-    img = img.resize((w, h), interp)
-    return img
+def letterbox_resize_file(fp, img_wh, bg=None, interp=None,
+                          reducing_gap=2.0):
+    """
+    `letterbox_resize` of an image file, decoding only as much as needed.
 
+    JPEGs are decoded at the smallest DCT scale (1/2, 1/4 or 1/8) that
+    keeps the image at least `reducing_gap` times the output size, which
+    skips most of the decoding work for big downscales. Compared to
+    `letterbox_resize(Image.open(fp), ...)`, pixels differ by about one
+    gray level on average, and up to ~10 on sharp edges. Other formats
+    are decoded in full.
+
+    :parameters:
+        - fp: path or file object
+        - img_wh, bg, interp: as in `letterbox_resize`
+        - reducing_gap: float, or None to decode at full size.
+            Larger values are slower and closer to a full decode.
+
+    >>> import io
+    >>> f = io.BytesIO()
+    >>> Image.new('L', (2000, 1000), 200).save(f, 'JPEG')
+    >>> _ = f.seek(0)
+    >>> img = letterbox_resize_file(f, (100, 100))
+    >>> img.size, img.getpixel((50, 10)), img.getpixel((50, 50))
+    ((100, 100), 0, 200)
+    """
+    w, h = img_wh
+    with Image.open(fp) as img:
+        if interp is None:
+            interp = _default_interp(img.size, (w, h))
+        # on a file that is not loaded yet, thumbnail decodes JPEGs in
+        # draft mode, and corrects for the rounding of the draft size
+        img.thumbnail((w, h), interp, reducing_gap=reducing_gap)
+        img.load()
+        return _letterbox_paste(img, (w, h), bg)
+
+
+def smart_resize_file(fp, img_wh, interp=None, reducing_gap=2.0):
+    """
+    `smart_resize` of an image file, decoding only as much as needed.
+    See `letterbox_resize_file`.
+
+    :parameters:
+        - fp: path or file object
+        - img_wh, interp: as in `smart_resize`
+        - reducing_gap: as in `letterbox_resize_file`
+
+    >>> import io
+    >>> f = io.BytesIO()
+    >>> Image.new('L', (3000, 2000), 128).save(f, 'JPEG')
+    >>> _ = f.seek(0)
+    >>> img = smart_resize_file(f, (300, None))
+    >>> img.size, img.getpixel((10, 10))
+    ((300, 200), 128)
+    """
+    with Image.open(fp) as img:
+        w, h = _smart_size(img.size, img_wh)
+        if interp is None:
+            interp = _default_interp(img.size, (w, h))
+        box = None
+        if reducing_gap is not None:
+            draft = img.draft(None, (int(w*reducing_gap),
+                                     int(h*reducing_gap)))
+            if draft is not None:
+                box = draft[1]
+        return img.resize((w, h), interp, box=box)
 
 
 def trim_percentage(img, percentage):
@@ -147,11 +283,20 @@ def trim_percentage(img, percentage):
     >>> imgt.size
     (90, 180)
     """
-    px_w = img.size[0]*(percentage/100.)
-    px_h = img.size[1]*(percentage/100.)
-    box = map(int, (px_w/2, px_h/2, img.size[0]-px_w/2, img.size[1]-px_h/2))
-    img = img.crop(box)
-    return img
+    return img.crop(trim_box(img.size, percentage))
+
+
+def trim_box(img_size, percentage):
+    """
+    box (left, upper, right, lower) cropped by `trim_percentage`
+
+    >>> trim_box((100, 200), 10)
+    (5, 10, 95, 190)
+    """
+    px_w = img_size[0]*(percentage/100.)
+    px_h = img_size[1]*(percentage/100.)
+    return tuple(int(x) for x in (px_w/2, px_h/2, img_size[0]-px_w/2,
+                                  img_size[1]-px_h/2))
 
 
 def crop_center(img, img_wh):
@@ -168,35 +313,110 @@ def crop_center(img, img_wh):
     >>> imgc.size
     (50, 50)
     """
-    w, h = img_wh
-    if w > img.size[0] or h > img.size[1]:
+    return img.crop(center_box(img.size, img_wh))
+
+
+def center_box(img_size, crop_wh):
+    """
+    box (left, upper, right, lower) cropped by `crop_center`
+
+    >>> center_box((128, 128), (50, 50))
+    (39, 39, 89, 89)
+    """
+    w, h = crop_wh
+    if w > img_size[0] or h > img_size[1]:
         raise ValueError('crop dimensions larger than image')
-    # box is left, upper, right, lower pixel
-    # img.size is width, height
-    size = (w, h)
-    col0 = (img.size[0]-size[0])//2
-    row0 = (img.size[1]-size[1])//2
-    box = (col0, row0, col0+size[0], row0+size[1])
-    return img.crop(box)
-
-
-# def draw_tiny_text(img, text, pos, color):
-#     """
-#     draws tiny text on image.
-#
-#     :parameters:
-#         - pos: tuple (int, int)
-#             x, y position of text from top left (TODO)
-#         - color: tuple (int, int, int)
-#             rgb int tuple of text
-#     """
-#     # TODO hack! and cache the font
-#     fontpath = (Path(__file__).realpath().parent)/'fonts/tom-thumb.pil'
-#     assert( fontpath.exists() )
-#     font = ImageFont.load(fontpath)
-#     #font = ImageFont.load('fonts/tom-thumb.pil')
-#     draw = ImageDraw.Draw(img)
-#     draw.text(pos, text, font=font, fill=color)
+    col0 = (img_size[0]-w)//2
+    row0 = (img_size[1]-h)//2
+    return (col0, row0, col0+w, row0+h)
+
+
+def _thumbnail_size(src_wh, img_wh):
+    """ size `Image.thumbnail(img_wh)` gives an image of size src_wh """
+    x, y = int(math.floor(img_wh[0])), int(math.floor(img_wh[1]))
+    if x >= src_wh[0] and y >= src_wh[1]:
+        return src_wh
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = float(src_wh[0])/src_wh[1]
+    if float(x)/y >= aspect:
+        x = round_aspect(y*aspect, key=lambda n: abs(aspect - float(n)/y))
+    else:
+        y = round_aspect(x/aspect, key=lambda n: 0 if n == 0 else
+                         abs(aspect - float(x)/n))
+    return int(x), int(y)
+
+
+def crop_resize(img, box, img_wh, letterbox=False, bg=None, interp=None,
+                reducing_gap=None, out=None):
+    """
+    Crop and resize in a single resample, without intermediate images.
+
+    Equivalent to `smart_resize(img.crop(box), img_wh)`, or with
+    `letterbox` to `letterbox_resize(img.crop(box), img_wh)`, but
+    resampling straight from the `box` region of `img`. Filter taps
+    near the edges of the box read the pixels just outside of it, so
+    border pixels may differ slightly from the chained version.
+
+    :parameters:
+        - img: input Image
+        - box: (left, upper, right, lower), may be fractional, e.g.
+            from `center_box` or `trim_box`. None for the whole image.
+        - img_wh: output width, height. Without letterbox either may
+            be None, as in `smart_resize`.
+        - letterbox: bool
+            fit the crop inside img_wh keeping its aspect ratio, like
+            `letterbox_resize`. Crops smaller than img_wh are not
+            enlarged.
+        - bg: letterbox background color
+        - interp: int
+            interpolation code from PIL.Image
+        - reducing_gap: float or None, as in `smart_resize`
+        - out: optional Image of size img_wh and the mode of img to
+            paste the result into, e.g. a letterbox canvas reused
+            across frames. Only the letterbox margins are cleared.
+
+    >>> img = Image.new('L', (400, 300), 255)
+    >>> box = center_box(img.size, (200, 100))
+    >>> crop_resize(img, box, (100, None)).size
+    (100, 50)
+    >>> canvas = Image.new('L', (64, 64))
+    >>> res = crop_resize(img, box, (64, 64), letterbox=True, out=canvas)
+    >>> res is canvas, res.getpixel((0, 0)), res.getpixel((32, 32))
+    (True, 0, 255)
+    """
+    if box is None:
+        box = (0, 0) + img.size
+    box = tuple(box)
+    src_wh = (box[2] - box[0], box[3] - box[1])
+    if letterbox:
+        w, h = img_wh
+        size = _thumbnail_size(src_wh, (w, h))
+    else:
+        w, h = size = _smart_size(src_wh, img_wh)
+
+    if out is not None and (out.size != (w, h) or out.mode != img.mode):
+        raise ValueError('out must be a {} image of size {}'.format(
+            img.mode, (w, h)))
+
+    if interp is None:
+        interp = _default_interp(src_wh, size)
+    if size != src_wh:
+        resized = img.resize(size, interp, box=box,
+                             reducing_gap=reducing_gap)
+    elif box != (0, 0) + img.size:
+        resized = img.crop(tuple(int(round(x)) for x in box))
+    else:
+        resized = img
+
+    if not letterbox:
+        if out is None:
+            return resized if resized is not img else img.copy()
+        out.paste(resized, (0, 0))
+        return out
+    return _letterbox_paste(resized, (w, h), bg, out)
 
 
 def draw_bbox(img, bb, color=None, width=1):
@@ -235,6 +455,122 @@ def draw_bbox(img, bb, color=None, width=1):
         draw.line((x0, y1, x0, y0), fill=color, width=width)
 
 
+def _default_bbox_color(mode):
+    if mode == 'L':
+        return 255
+    elif mode == 'RGB':
+        return (255, 0, 0)
+    elif mode == 'RGBA':
+        return (255, 0, 0, 255)
+
+
+def _fill_rects(arr, frames, y0, y1, x0, x1, values):
+    """ Fill [y0, y1) x [x0, x1) rectangles as slices of `arr`, in order.
+    Coordinates are clipped to the array.
+    """
+    h, w = (arr.shape[1:3] if frames is not None else arr.shape[:2])
+    y0, y1 = np.clip(y0, 0, h).tolist(), np.clip(y1, 0, h).tolist()
+    x0, x1 = np.clip(x0, 0, w).tolist(), np.clip(x1, 0, w).tolist()
+    if frames is None:
+        for i, value in enumerate(values):
+            arr[y0[i]:y1[i], x0[i]:x1[i]] = value
+    else:
+        frames = frames.tolist()
+        for i, value in enumerate(values):
+            arr[frames[i], y0[i]:y1[i], x0[i]:x1[i]] = value
+
+
+def draw_bboxes(images, boxes, colors=None, widths=1, frames=None):
+    """ Draw many bounding boxes in-place, in one vectorized pass.
+
+    Box geometry is computed for all boxes at once, and edges are filled
+    as slices directly on the pixel array, `width` pixels thick inside the
+    box. This matches ``ImageDraw.rectangle(bb, outline=color,
+    width=width)`` for boxes at least 2*width wide and high. Thinner boxes
+    are filled, never drawn outside of, while ImageDraw spills past them.
+
+    :parameters:
+        - images: PIL image, HxW(xC) ndarray, or NxHxW(xC) ndarray batch.
+          A 3-D array is read as HxWxC unless `frames` is given, so
+          NxHxW gray batches need `frames`.
+          PIL images are updated in-place; images created with
+          `array_to_image(..., writable=True)` are drawn on without copies.
+          Other PIL images are copied to an array and pasted back, two
+          full-image copies per call, so draw all boxes of a frame in one
+          call, or keep frames as arrays.
+        - boxes: (N, 4) array of x0, y0, x1, y1 (inclusive), or (N, 2, 2)
+          x is cols, y is rows
+        - colors: one color, or one color per box. Default as `draw_bbox`.
+        - widths: int, or one int per box
+        - frames: (N,) index of the frame each box belongs to.
+          Required for batches.
+
+    >>> arr = np.zeros((2, 6, 6), dtype='uint8')
+    >>> draw_bboxes(arr, [[1, 1, 4, 4], [0, 0, 5, 5]], colors=[7, 9],
+    ...             widths=[2, 1], frames=[0, 1])
+    >>> arr[0]
+    array([[0, 0, 0, 0, 0, 0],
+           [0, 7, 7, 7, 7, 0],
+           [0, 7, 7, 7, 7, 0],
+           [0, 7, 7, 7, 7, 0],
+           [0, 7, 7, 7, 7, 0],
+           [0, 0, 0, 0, 0, 0]], dtype=uint8)
+    >>> draw_bboxes(arr, [[1, 1, 4, 4], [0, 0, 5, 5]], colors=[7, 9])
+    Traceback (most recent call last):
+    ...
+    ValueError: colors of shape (2,) do not fit 2 boxes on pixels of \
+shape (6,); 3-D images are HxWxC unless frames is given
+    >>> img = Image.new('RGB', (8, 8))
+    >>> draw_bboxes(img, [[2, 2, 5, 5]])
+    >>> img.getpixel((2, 5)), img.getpixel((3, 3))
+    ((255, 0, 0), (0, 0, 0))
+    """
+    boxes = np.asarray(boxes, dtype='int64').reshape(-1, 4)
+    n = len(boxes)
+
+    pil_img = None
+    if isinstance(images, Image.Image):
+        pil_img = images
+        if colors is None:
+            colors = _default_bbox_color(pil_img.mode)
+        try:
+            images = image_to_array(pil_img, writable=True, allow_copy=False)
+            pil_img = None
+        except ValueError:
+            # not backed by an array; draw on a copy and paste it back
+            images = np.array(pil_img)
+    elif frames is None and images.ndim == 4:
+        raise ValueError('frames is required for batches')
+
+    batch = frames is not None
+    pixel_shape = images.shape[3:] if batch else images.shape[2:]
+    if colors is None:
+        colors = 255 if not pixel_shape else (255, 0, 0, 255)[:pixel_shape[0]]
+    colors = np.asarray(colors, dtype=images.dtype)
+    per_box = colors if colors.ndim > len(pixel_shape) else colors[None]
+    if per_box.shape[1:] != pixel_shape or len(per_box) not in (1, n):
+        raise ValueError('colors of shape {} do not fit {} boxes on pixels '
+                         'of shape {}; 3-D images are HxWxC unless frames '
+                         'is given'.format(colors.shape, n, pixel_shape))
+    colors = np.broadcast_to(per_box, (n,) + pixel_shape)
+    widths = np.broadcast_to(np.maximum(np.asarray(widths), 1), (n,))
+
+    x0, y0 = boxes[:, 0], boxes[:, 1]
+    x1, y1 = boxes[:, 2] + 1, boxes[:, 3] + 1
+    # top, bottom, left, right edge of every box, interleaved per box
+    ry0 = np.stack([y0, np.maximum(y0, y1 - widths), y0, y0], 1)
+    ry1 = np.stack([np.minimum(y1, y0 + widths), y1, y1, y1], 1)
+    rx0 = np.stack([x0, x0, x0, np.maximum(x0, x1 - widths)], 1)
+    rx1 = np.stack([x1, x1, np.minimum(x1, x0 + widths), x1], 1)
+    if batch:
+        frames = np.repeat(np.asarray(frames, dtype='int64'), 4)
+    _fill_rects(images, frames, ry0.ravel(), ry1.ravel(), rx0.ravel(),
+                rx1.ravel(), np.repeat(colors, 4, axis=0))
+
+    if pil_img is not None:
+        pil_img.paste(array_to_image(images), (0, 0))
+
+
 def add_border(img, px, color=None):
     """ add border to image.
     :parameters:
@@ -253,10 +589,114 @@ def add_border(img, px, color=None):
     return ImageOps.expand(img, px, color)
 
 
-def hstack(images, variable_width=True):
-    """ stack PIL images downwards.
+def _common_mode(modes):
+    """ mode all of `modes` can be converted to without losing channels """
+    if _all_equal(modes):
+        return modes[0]
+    if any('A' in mode for mode in modes):
+        return 'RGBA'
+    return 'RGB'
+
+
+def _is_array_input(images, out):
+    return isinstance(images, np.ndarray) or isinstance(out, np.ndarray) or \
+        any(isinstance(img, np.ndarray) for img in images)
+
+
+def _stack_arrays(images, axis, bg, out):
+    """ stack HxW(xC) arrays or images along axis 0 (downwards) or 1
+    (sideways), padding the other axis with bg.
+    """
+    arrays = [img if isinstance(img, np.ndarray) else np.asarray(img)
+              for img in images]
+    other = 1 - axis
+    channels = [a.shape[2] for a in arrays if a.ndim == 3]
+    shape = [0, 0]
+    shape[axis] = sum(a.shape[axis] for a in arrays)
+    shape[other] = max(a.shape[other] for a in arrays)
+    if channels:
+        shape.append(max(channels))
+        if len(set(channels) - {1}) > 1 and set(channels) != {3, 4}:
+            raise ValueError('cannot stack arrays with {} channels'.format(
+                ' and '.join(str(c) for c in sorted(set(channels)))))
+    shape = tuple(shape)
+    if out is None:
+        out = np.empty(shape, dtype=np.result_type(*arrays))
+    elif out.shape != shape:
+        raise ValueError('out must have shape {}'.format(shape))
+    if bg is None:
+        bg = 0
+
+    pos = 0
+    for a in arrays:
+        if a.ndim == 2 and len(shape) == 3:
+            # gray images go in all channels
+            a = a[..., np.newaxis]
+        index = [slice(None), slice(None)]
+        index[axis] = slice(pos, pos + a.shape[axis])
+        region = out[tuple(index)]
+        index = [slice(None), slice(None)]
+        index[other] = slice(0, a.shape[other])
+        if len(shape) == 3 and a.shape[2] < shape[2] == 4:
+            # gray or RGB among RGBA: color channels, and opaque alpha
+            region[tuple(index)][..., :3] = a
+            region[tuple(index)][..., 3] = 255
+        else:
+            region[tuple(index)] = a
+        if a.shape[other] < shape[other]:
+            index[other] = slice(a.shape[other], None)
+            region[tuple(index)] = bg
+        pos += a.shape[axis]
+    return out
+
+
+def _stack_images(images, axis, bg, out):
+    """ PIL version of `_stack_arrays` """
+    sizes = [img.size for img in images]
+    # PIL sizes are (w, h), so downwards is along index 1
+    along, across = (1, 0) if axis == 0 else (0, 1)
+    size = [0, 0]
+    size[along] = sum(s[along] for s in sizes)
+    size[across] = max(s[across] for s in sizes)
+    size = tuple(size)
+    mode = _common_mode([img.mode for img in images])
+    if bg is None:
+        bg = 0
+    if out is None:
+        out = Image.new(mode, size, bg)
+    elif out.size != size or out.mode != mode:
+        raise ValueError('out must be a {} image of size {}'.format(mode,
+                                                                    size))
+    elif not _all_equal([s[across] for s in sizes]):
+        out.paste(bg, (0, 0) + size)
+    pos = [0, 0]
+    for s, img in zip(sizes, images):
+        if img.mode != mode:
+            img = img.convert(mode)
+        out.paste(img, tuple(pos))
+        pos[along] += s[along]
+    return out
+
+
+def hstack(images, variable_width=True, bg=None, out=None):
+    """ stack images downwards.
     unless variable_width is False, width equals max width of all images.
 
+    Works on PIL images, HxW(xC) arrays, or an NxHxW(xC) batch array.
+    With any array among the inputs, or an array `out`, the result is
+    an array; gray arrays are broadcast into all color channels of color
+    ones, and gray or 3 channel arrays stacked with 4 channel ones get
+    an alpha of 255, like PIL images converted to RGBA. Other mixes of
+    channels raise ValueError.
+    Otherwise it is a PIL image, in the mode of the inputs, or RGB(A)
+    if they are mixed.
+
+    :parameters:
+        - images: sequence of PIL images or arrays, or batch array
+        - variable_width: bool
+        - bg: color of the space right of narrower images, default black
+        - out: optional preallocated array or PIL image for the result
+
     >>> img1 = Image.new('L', (128, 128))
     >>> img2 = Image.new('L', (128, 128))
     >>> imgs = hstack((img1, img2))
@@ -266,50 +706,101 @@ def hstack(images, variable_width=True):
     >>> imgs2 = hstack((img1, img3))
     >>> imgs2.size
     (256, 256)
+    >>> batch = np.ones((4, 10, 20, 3), dtype='uint8')
+    >>> out = np.empty((40, 20, 3), dtype='uint8')
+    >>> hstack(batch, out=out) is out
+    True
+    >>> hstack([np.zeros((2, 3)), np.ones((1, 2))], bg=9).tolist()
+    [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [1.0, 1.0, 9.0]]
+    >>> rgba = hstack([np.zeros((1, 1, 3), 'uint8'),
+    ...                np.zeros((1, 1, 4), 'uint8')])
+    >>> rgba.shape, rgba[0, 0].tolist()
+    ((2, 1, 4), [0, 0, 0, 255])
     """
-
-    widths, heights = zip(*[img.size for img in images])
-
+    if len(images) == 0:
+        raise ValueError('no images in sequence')
+    widths = [img.shape[1] if isinstance(img, np.ndarray) else img.size[0]
+              for img in images]
     if not variable_width and not _all_equal(widths):
         raise ValueError('widths must be the same')
-
-    out_w = max(widths)
-    out_h = sum(heights)
-    out = Image.new(images[0].mode, (out_w, out_h))
-    cum_h = 0
-    for h, img in zip(heights, images):
-        out.paste(img, (0, cum_h))
-        cum_h += h
-    return out
+    if _is_array_input(images, out):
+        return _stack_arrays(images, 0, bg, out)
+    return _stack_images(images, 0, bg, out)
 
 
-def vstack(images, variable_height=True):
-    """ Stack PIL images sideways.
+def vstack(images, variable_height=True, bg=None, out=None):
+    """ Stack images sideways.
     unless variable_height is False, height equals max height of all images.
-    """
-
-    widths, heights = zip(*[img.size for img in images])
+    Inputs and outputs are as in `hstack`.
 
+    >>> img = vstack([Image.new('L', (10, 5)), Image.new('RGB', (4, 8))])
+    >>> img.mode, img.size
+    ('RGB', (14, 8))
+    >>> vstack(np.zeros((3, 4, 5), dtype='uint8')).shape
+    (4, 15)
+    """
+    if len(images) == 0:
+        raise ValueError('no images in sequence')
+    heights = [img.shape[0] if isinstance(img, np.ndarray) else img.size[1]
+               for img in images]
     if not variable_height and not _all_equal(heights):
         raise ValueError('heights must be the same')
+    if _is_array_input(images, out):
+        return _stack_arrays(images, 1, bg, out)
+    return _stack_images(images, 1, bg, out)
 
-    out_w = sum(widths)
-    out_h = max(heights)
-    out = Image.new(images[0].mode, (out_w, out_h))
-    cum_w = 0
-    for w, img in zip(widths, images):
-        out.paste(img, (cum_w, 0))
-        cum_w += w
-    return out
 
+def dstack_rgb(images, fill=0, out=None):
+    """ Stack single channel images in depth, as RGB channels.
+
+    Any of the three may be None, to fill that channel with `fill`.
+    With any array among the inputs, or an array `out`, the result is
+    an ...x3 array: inputs may then be HxW arrays or NxHxW batches, and
+    missing channels are filled from a broadcast constant, without
+    allocating planes for them. Otherwise it is an RGB PIL image.
 
-def dstack_rgb(images):
-    """ Stack PIL images in depth, as RGB channels.
+    :parameters:
+        - images: sequence of 3 L images, arrays or None
+        - fill: int
+            value of missing channels
+        - out: optional preallocated ...x3 array
+
+    >>> r = Image.new('L', (4, 2), 255)
+    >>> dstack_rgb([r, None, None]).getpixel((0, 0))
+    (255, 0, 0)
+    >>> out = np.empty((5, 2, 4, 3), dtype='uint8')
+    >>> t = dstack_rgb([None, np.full((5, 2, 4), 7, 'uint8'), None], 1, out)
+    >>> t is out, t[0, 0, 0].tolist()
+    (True, [1, 7, 1])
     """
-    # TODO auto fill-in None
     if not len(images) == 3:
         raise ValueError('need 3 images')
-    out = Image.merge('RGB', images)
+    present = [img for img in images if img is not None]
+    if not present:
+        raise ValueError('need at least one image')
+
+    if not _is_array_input(present, out):
+        if len(present) == 3:
+            return Image.merge('RGB', images)
+        # one plane serves all missing channels
+        blank = Image.new('L', present[0].size, fill)
+        return Image.merge('RGB', [blank if img is None else img
+                                   for img in images])
+
+    planes = [img if img is None or isinstance(img, np.ndarray)
+              else np.asarray(img) for img in images]
+    shape = next(p for p in planes if p is not None).shape
+    if not _all_equal([p.shape for p in planes if p is not None]):
+        raise ValueError('all images must have same size')
+    if out is None:
+        dtype = np.result_type(*[p for p in planes if p is not None])
+        out = np.empty(shape + (3,), dtype=dtype)
+    elif out.shape != shape + (3,):
+        raise ValueError('out must have shape {}'.format(shape + (3,)))
+    for c, plane in enumerate(planes):
+        if plane is None:
+            plane = np.broadcast_to(out.dtype.type(fill), shape)
+        out[..., c] = plane
     return out
 
 
@@ -343,78 +834,255 @@ def square_montage(images, resize_mode='center', bg=None, border_color=None):
 
     """
 
-    # TODO resize modes
+    # imported here, compositing depends on this module
+    from .compositing import MontageLayout, render_montage
 
     images = list(images)
-    if bg is None:
-        bg = _default_color(images[0].mode, 0)
-    if border_color is None:
-        border_color = _default_color(images[0].mode, 20, transparent=False)
-    num_images = len(images)
-    num_cols = int(round(np.sqrt(num_images)))
-    num_rows = int(np.ceil(float(num_images)/num_cols))
-    widths, heights = zip(*[img.size for img in images])
-    w, h = max(widths), max(heights)
-    montage = Image.new(images[0].mode, (num_cols*w, num_rows*h), bg)
-    if resize_mode=='center':
-        resized_images = [letterbox_resize(img, (w, h), bg) for img in images]
-    elif resize_mode=='none':
-        resized_images = images[:]
-    else:
-        raise ValueError('unknown resize_mode')
-    for i, img in enumerate(resized_images):
-        img = ImageOps.expand(img, 1, border_color)
-        r, c = i/num_cols, i%num_cols
-        x, y = c*w, r*h
-        montage.paste(img, (x, y))
-    return montage
+    w, h = (max(size) for size in zip(*[img.size for img in images]))
+    layout = MontageLayout(len(images), (w, h))
+    return render_montage(images, layout, images[0].mode, bg=bg,
+                          resize_mode=resize_mode, border=1,
+                          border_color=border_color)
+
+
+_MODE_CHANNELS = {'L': 1, 'RGB': 3, 'RGBA': 4}
+
 
+def _open_image(img):
+    if isinstance(img, Image.Image):
+        return img
+    # paths and file objects are opened lazily, decoded in the workers
+    return Image.open(img)
 
-def images_to_tensor4(images, order='nchw'):
+
+def _image_header(img):
+    """ mode and size of an image, path or file object """
+    if isinstance(img, Image.Image):
+        return img.mode, img.size
+    with Image.open(img) as opened:
+        return opened.mode, opened.size
+
+
+def images_to_tensor4(images, order='nchw', out=None, dtype='u1',
+                      mean=None, std=None, num_threads=None):
     """ Convert sequence of PIL images to 4D ndarray tensor.
     Dims will be (N, C, H, W) or (N, H, W, C)
+
+    Images are decoded and copied into the tensor in parallel threads,
+    each written straight into its slot of the output. For float dtypes,
+    per-channel normalization `(pixel - mean)/std` is applied in the
+    same pass. Paths are opened one at a time by the workers, so only
+    the first one is read before the output is allocated; the others
+    are checked for mode and size as they are decoded.
+
+    :parameters:
+        - images: sequence of PIL images, paths or file objects
+        - order: string
+            nchw or nhwc
+        - out: ndarray or BufferPool
+            preallocated output tensor of the right shape and dtype,
+            or pool to take it from. If None, a new array.
+        - dtype: output dtype. uint8, or a float type for normalization.
+        - mean: float or sequence of floats, one per channel
+        - std: float or sequence of floats, one per channel
+        - num_threads: int
+            number of worker threads, defaults to number of cpus.
+
+    >>> imgs = [Image.new('L', (4, 2), 10), Image.new('L', (4, 2), 20)]
+    >>> images_to_tensor4(imgs).shape
+    (2, 1, 2, 4)
+    >>> t = images_to_tensor4(imgs, 'nhwc', dtype='float32', mean=10, std=5)
+    >>> t.shape, t.dtype, t[:, 0, 0, 0].tolist()
+    ((2, 2, 4, 1), dtype('float32'), [0.0, 2.0])
     """
-    if not _all_equal([img.mode for img in images]):
-        raise ValueError('all images must have same mode')
-    if not _all_equal([img.size for img in images]):
-        raise ValueError('all images must have same size')
+    images = list(images)
     if len(images)==0:
         raise ValueError('no images in sequence')
+    loaded = [img for img in images if isinstance(img, Image.Image)]
+    if not _all_equal([img.mode for img in loaded]):
+        raise ValueError('all images must have same mode')
+    if not _all_equal([img.size for img in loaded]):
+        raise ValueError('all images must have same size')
     n = len(images)
-    if images[0].mode == 'RGB':
-        c = 3
-    elif images[0].mode == 'RGBA':
-        c = 4
-    elif images[0].mode == 'L':
-        c = 1
-    else:
+    mode, (w, h) = _image_header(loaded[0] if loaded else images[0])
+    if mode not in _MODE_CHANNELS:
         raise ValueError('unsupported image mode')
-    w = images[0].size[0]
-    h = images[0].size[1]
+    c = _MODE_CHANNELS[mode]
     if order == 'nchw':
-        out = np.empty((n, c, h, w), dtype='u1')
+        shape = (n, c, h, w)
     elif order == 'nhwc':
-        out = np.empty((n, h, w, c), dtype='u1')
+        shape = (n, h, w, c)
     else:
         raise ValueError('unknown order, should be nchw or nhwc')
-    for i, img in enumerate(images):
-        imga = np.asarray(img)
+
+    dtype = np.dtype(dtype)
+    normalize = mean is not None or std is not None
+    if normalize:
+        if dtype.kind != 'f':
+            raise ValueError('normalization needs a float dtype')
+        mean = np.asarray(0. if mean is None else mean, dtype=dtype)
+        inv_std = 1./np.asarray(1. if std is None else std, dtype=dtype)
+
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif isinstance(out, BufferPool):
+        out = out.get(shape, dtype)
+    elif out.shape != shape or out.dtype != dtype:
+        raise ValueError('out must be {} array of shape {}'.format(
+            dtype, shape))
+
+    local = threading.local()
+
+    def copy(i, img):
+        if img.mode != mode or img.size != (w, h):
+            raise ValueError('all images must have same mode and size')
+        dst = out[i]
         if order == 'nchw':
-            imga = imga.transpose((2, 0, 1))
-        out[i] = imga
+            dst = dst.transpose((1, 2, 0))
+        if not normalize and can_share_memory(_squeeze_channel(dst), mode):
+            # L and RGBA nhwc: PIL decodes straight into the tensor
+            array_to_image(_squeeze_channel(dst), mode,
+                           writable=True).paste(img, (0, 0))
+            return
+        if mode == 'RGB':
+            # PIL stores RGB with 4 bytes per pixel, so pasting into a
+            # shared buffer would convert; np.asarray is one plain copy
+            src = np.asarray(img)
+        else:
+            # reusable per-thread buffer, instead of a new array per image
+            buf = getattr(local, 'buf', None)
+            if buf is None:
+                buf = local.buf = new_shared_image(mode, (w, h))
+            buf[0].paste(img, (0, 0))
+            src = buf[1]
+        if c == 1:
+            src = src.reshape((h, w, 1))
+        if normalize:
+            np.subtract(src, mean, out=dst, dtype=dtype)
+            dst *= inv_std
+        else:
+            dst[...] = src
+
+    def work(i):
+        img = images[i]
+        if isinstance(img, Image.Image):
+            copy(i, img)
+        else:
+            with Image.open(img) as img:
+                copy(i, img)
+
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    if num_threads <= 1 or n == 1:
+        for i in range(n):
+            work(i)
+    else:
+        with ThreadPoolExecutor(min(num_threads, n)) as pool:
+            for _ in pool.map(work, range(n)):
+                pass
     return out
 
 
-def tensor4_to_images(tensor, order='nchw'):
-    """ Convert a 4D ndarray to a list of images. """
-    out = []
-    for i in range(tensor.shape[0]):
-        img = tensor[i]
-        if order == 'nchw':
-            img = img.transpose((1, 2, 0))
-        pimg = Image.fromarray(img)
-        out.append(pimg)
-    return out
+class Tensor4Images(object):
+    """ Lazy sequence of PIL images over a 4D ndarray tensor.
+
+    Images are only created when indexed or iterated. Slices of a
+    C-contiguous nhwc tensor are wrapped without copying where PIL allows
+    it (modes L and RGBA; see `can_share_memory`), as read-only images
+    that see later changes to the tensor. nchw slices are transposed
+    into a scratch buffer, one per thread, and copied from there into
+    a new image unless `reuse_buffer` is set.
+
+    :parameters:
+        - tensor: 4D ndarray
+        - order: string
+            nchw or nhwc
+        - reuse_buffer: bool
+            for nchw, return images backed by the scratch buffer itself.
+            Each image is then only valid until the next one is created
+            in the same thread, e.g. for saving a batch image by image.
+
+    >>> t = np.zeros((3, 1, 2, 4), dtype='uint8')
+    >>> imgs = Tensor4Images(t)
+    >>> len(imgs), imgs[-1].size, imgs[-1].mode
+    (3, (4, 2), 'L')
+    >>> len(imgs[1:])
+    2
+    >>> [img.size for img in Tensor4Images(t.transpose(0, 2, 3, 1), 'nhwc')]
+    [(4, 2), (4, 2), (4, 2)]
+    """
+
+    def __init__(self, tensor, order='nchw', reuse_buffer=False):
+        if tensor.ndim != 4:
+            raise ValueError('tensor must be 4D')
+        if order not in ('nchw', 'nhwc'):
+            raise ValueError('unknown order, should be nchw or nhwc')
+        self.tensor = tensor
+        self.order = order
+        self.reuse_buffer = reuse_buffer
+        self._local = threading.local()
+
+    def __len__(self):
+        return self.tensor.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Tensor4Images(self.tensor[i], self.order,
+                                 self.reuse_buffer)
+        img = self.tensor[i]
+        if self.order == 'nhwc':
+            return array_to_image(_squeeze_channel(img))
+
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None:
+            scratch = self._local.scratch = np.empty(
+                img.shape[1:] + img.shape[:1], dtype=img.dtype)
+        scratch[...] = img.transpose((1, 2, 0))
+        img = _squeeze_channel(scratch)
+        if self.reuse_buffer or not can_share_memory(img):
+            return array_to_image(img)
+        # detach from the scratch buffer
+        return array_to_image(img).copy()
+
+
+def _squeeze_channel(arr):
+    if arr.shape[2] == 1:
+        return arr.reshape(arr.shape[:2])
+    return arr
+
+
+def tensor4_to_images(tensor, order='nchw', lazy=False, reuse_buffer=False):
+    """ Convert a 4D ndarray to a list of images.
+
+    :parameters:
+        - tensor: 4D ndarray
+        - order: string
+            nchw or nhwc
+        - lazy: bool
+            return a lazy `Tensor4Images` sequence instead of a list.
+            Its images may share memory with `tensor`.
+        - reuse_buffer: bool
+            see `Tensor4Images`. Only used if lazy.
+
+    >>> t = np.zeros((2, 3, 4, 1), dtype='uint8')
+    >>> imgs = tensor4_to_images(t, 'nhwc')
+    >>> t[...] = 9
+    >>> imgs[0].getpixel((0, 0))
+    0
+    """
+    images = Tensor4Images(tensor, order, reuse_buffer=lazy and reuse_buffer)
+    if lazy:
+        return images
+    if order == 'nchw':
+        # nchw images are already copies out of the scratch buffer
+        return list(images)
+    # detach nhwc views from the tensor
+    return [img.copy() if can_share_memory(_squeeze_channel(tensor[i]))
+            else img for i, img in enumerate(images)]
 
 
 def montage(images,
@@ -434,46 +1102,24 @@ def montage(images,
         - padding: int
             padding between images
     """
+    # imported here, compositing depends on this module
+    from .compositing import MontageLayout, render_montage
+
     images = list(images)
     if len(images) == 0:
         raise ValueError('No images given')
-    imgw, imgh = images[0].size
 
     if not _all_equal([img.size for img in images]):
         raise ValueError('all images should be same size')
 
-    (marl, mart, marr, marb) = margins_ltrb
-
-    # calculate the size of the output image, based on the
-    # photo thumb sizes, margins, and padding
-    marw = marl + marr
-    marh = mart + marb
-
-    padw = (ncols-1) * padding
-    padh = (nrows-1) * padding
-    isize = ((ncols * imgw) + marw + padw,
-             (nrows * imgh) + marh + padh)
-
-    # Create the new image. The background doesn't have to be white
+    layout = MontageLayout(len(images), images[0].size, ncols, nrows,
+                           margins_ltrb, padding)
+    # the background doesn't have to be white
     white = (255, 255, 255)
-    inew = Image.new('RGB', isize, white)
-
-    # Insert each thumb:
-    for irow in range(nrows):
-        for icol in range(ncols):
-            left = marl + icol * (imgw + padding)
-            right = left + imgw
-            upper = mart + irow * (imgh + padding)
-            lower = upper + imgh
-            bbox = (left, upper, right, lower)
-            try:
-                img = images.pop(0)
-            except IndexError:
-                break
-            inew.paste(img, bbox)
-    return inew
+    return render_montage(images, layout, 'RGB', bg=white)
 
 
+# relative imports need the package: python -m imgutils.pil_utils
 if __name__ == '__main__':
     import doctest
     flags = doctest.REPORT_NDIFF
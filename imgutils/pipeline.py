@@ -0,0 +1,125 @@
+
+__all__ = ['Pipeline']
+
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
+
+from .pil_utils import _open_image
+from .pil_utils import images_to_tensor4
+
+
+class Pipeline(object):
+    """ Lazy chain of image transforms, with optional batching to tensors.
+
+    Transforms are functions taking an image and returning one, applied
+    in order. Inputs are pulled from any iterable only as outputs are
+    consumed, and at most `read_ahead` images are in flight at a time,
+    so memory stays proportional to the batch size rather than the
+    dataset.
+
+    >>> from PIL import Image
+    >>> from imgutils.pil_utils import crop_center, smart_resize, add_border
+    >>> pipe = (Pipeline()
+    ...         .then(crop_center, (100, 100))
+    ...         .then(smart_resize, (32, None))
+    ...         .then(add_border, 2))
+    >>> images = (Image.new('RGB', (160, 120), (i, 0, 0)) for i in range(5))
+    >>> [b.shape for b in pipe.batches(images, 2, order='nhwc')]
+    [(2, 36, 36, 3), (2, 36, 36, 3), (1, 36, 36, 3)]
+    >>> pipe(Image.new('L', (100, 200))).size
+    (36, 36)
+    """
+
+    def __init__(self, *transforms):
+        self.transforms = tuple(transforms)
+
+    def then(self, func, *args, **kwargs):
+        """ new Pipeline that also applies `func(img, *args, **kwargs)` """
+        if args or kwargs:
+            func = _bind(func, args, kwargs)
+        return Pipeline(*(self.transforms + (func,)))
+
+    def __call__(self, img):
+        """ apply all transforms to one image, path or file object """
+        img = _open_image(img)
+        for transform in self.transforms:
+            img = transform(img)
+        return img
+
+    def __len__(self):
+        return len(self.transforms)
+
+    def map(self, images, num_threads=0, read_ahead=None):
+        """ Iterator of transformed images, in input order.
+
+        :parameters:
+            - images: iterable of PIL images, paths or file objects
+            - num_threads: int
+                worker threads applying the transforms; 0 applies them
+                in the consuming thread.
+            - read_ahead: int
+                most images being transformed ahead of the consumer,
+                default is 2*num_threads.
+        """
+        if not num_threads:
+            for img in images:
+                yield self(img)
+            return
+        if read_ahead is None:
+            read_ahead = 2*num_threads
+        read_ahead = max(read_ahead, 1)
+        images = iter(images)
+        with ThreadPoolExecutor(num_threads) as pool:
+            pending = deque(pool.submit(self, img)
+                            for img in itertools.islice(images, read_ahead))
+            try:
+                while pending:
+                    result = pending.popleft().result()
+                    for img in itertools.islice(images, 1):
+                        pending.append(pool.submit(self, img))
+                    yield result
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def batches(self, images, batch_size, order='nchw', dtype='u1',
+                mean=None, std=None, out=None, drop_last=False,
+                num_threads=0, read_ahead=None):
+        """ Iterator of 4D tensors of up to `batch_size` transformed
+        images, made with `images_to_tensor4`.
+
+        :parameters:
+            - images: iterable of PIL images, paths or file objects
+            - batch_size: int
+            - order, dtype, mean, std: as in `images_to_tensor4`
+            - out: optional BufferPool to take batch tensors from, so
+                they can be recycled with `out.release(batch)` once used.
+            - drop_last: bool
+                skip a last batch smaller than batch_size.
+            - num_threads, read_ahead: as in `map`. read_ahead defaults
+                to batch_size, so the next batch is being prepared while
+                the current one is used.
+        """
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        if read_ahead is None and num_threads:
+            read_ahead = batch_size
+        transformed = self.map(images, num_threads, read_ahead)
+        while True:
+            batch = list(itertools.islice(transformed, batch_size))
+            if not batch or (drop_last and len(batch) < batch_size):
+                return
+            # images are already decoded, so copying needs no threads
+            yield images_to_tensor4(batch, order, out=out, dtype=dtype,
+                                    mean=mean, std=std, num_threads=1)
+
+
+def _bind(func, args, kwargs):
+    """ func(img, *args, **kwargs) as a function of img only """
+    @functools.wraps(func)
+    def bound(img):
+        return func(img, *args, **kwargs)
+    return bound
@@ -0,0 +1,236 @@
+
+__all__ = ['build_pyramid', 'montage_pyramid']
+
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from .compositing import write_montage
+from .np_pil_interop import array_to_image
+
+
+_DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+  Format="{fmt}" Overlap="{overlap}" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+# rows of the previous level averaged at a time
+_STRIP_ROWS = 512
+
+
+def _halve(arr, out):
+    """ 2x box reduction of `arr` into `out`, in strips of rows.
+    Odd sizes replicate the last row/column.
+    """
+    h, w = arr.shape[:2]
+    for r0 in range(0, out.shape[0], _STRIP_ROWS//2):
+        r1 = min(out.shape[0], r0 + _STRIP_ROWS//2)
+        strip = np.asarray(arr[2*r0:2*r1], dtype='uint16')
+        rows = np.minimum(np.arange(2*(r1-r0)), len(strip)-1)
+        cols = np.minimum(np.arange(2*out.shape[1]), w-1)
+        if len(rows) != len(strip) or len(cols) != w:
+            strip = strip[rows][:, cols]
+        acc = strip[0::2, 0::2] + strip[1::2, 0::2]
+        acc += strip[0::2, 1::2]
+        acc += strip[1::2, 1::2]
+        acc += 2
+        acc >>= 2
+        out[r0:r1] = acc
+
+
+def _tile_boxes(h, w, tile_size, overlap):
+    """ yield (col, row, (top, left, bottom, right)) of every tile """
+    for row in range(int(math.ceil(float(h)/tile_size))):
+        for col in range(int(math.ceil(float(w)/tile_size))):
+            top = max(0, row*tile_size - overlap)
+            left = max(0, col*tile_size - overlap)
+            bottom = min(h, (row+1)*tile_size + overlap)
+            right = min(w, (col+1)*tile_size + overlap)
+            yield col, row, (top, left, bottom, right)
+
+
+def build_pyramid(img, out_dir, name='pyramid', tile_size=256, overlap=0,
+                  fmt=None, scheme='dzi', save_kwargs=None,
+                  num_threads=None):
+    """ Cut an image into a multi-resolution tile pyramid for web viewers.
+
+    Each level is a 2x box reduction of the previous one, not of the full
+    resolution image. Tiles of a level are encoded in parallel threads.
+    For np.memmap input, reduced levels are also kept in temporary
+    memmaps, so the full image never needs to fit in memory.
+
+    :parameters:
+        - img: PIL image, or HxW, HxWx3 or HxWx4 uint8 ndarray / np.memmap.
+            P images are converted to RGB, or RGBA if they have
+            transparency; other modes than L, RGB and RGBA are rejected.
+        - out_dir: output directory
+        - name: base name of the pyramid (dzi only)
+        - tile_size: int
+        - overlap: int
+            pixels of overlap between neighbouring tiles (dzi only)
+        - fmt: string
+            tile image format extension, e.g. jpg or png. Defaults to
+            png for images with alpha, and jpg otherwise.
+        - scheme: string
+            dzi: `<name>.dzi` plus `<name>_files/<level>/<col>_<row>.<fmt>`,
+            with level 0 being 1x1 pixels.
+            xyz: `<z>/<x>/<y>.<fmt>`, with z=0 being the level that fits
+            in one tile.
+        - save_kwargs: dict
+            extra arguments for PIL `Image.save`, e.g. quality
+        - num_threads: int
+            number of encoding threads, defaults to number of cpus.
+
+    :returns:
+        path of the .dzi file, or `out_dir` for xyz.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> dzi = build_pyramid(Image.new('RGB', (300, 200)), d, tile_size=256)
+    >>> sorted(os.listdir(os.path.join(d, 'pyramid_files')))[-2:]
+    ['8', '9']
+    >>> sorted(os.listdir(os.path.join(d, 'pyramid_files', '9')))
+    ['0_0.jpg', '1_0.jpg']
+    >>> _ = build_pyramid(Image.new('L', (300, 200)), d, scheme='xyz')
+    >>> sorted(os.listdir(d))
+    ['0', '1', 'pyramid.dzi', 'pyramid_files']
+    >>> _ = build_pyramid(Image.new('RGBA', (10, 10)), d, name='alpha')
+    >>> os.listdir(os.path.join(d, 'alpha_files', '4'))
+    ['0_0.png']
+    """
+    if scheme not in ('dzi', 'xyz'):
+        raise ValueError('unknown scheme, should be dzi or xyz')
+    if isinstance(img, Image.Image):
+        if img.mode == 'P':
+            # box-averaging palette indices would mix unrelated colors
+            img = img.convert('RGBA' if 'transparency' in img.info
+                              else 'RGB')
+        if img.mode not in ('L', 'RGB', 'RGBA'):
+            raise ValueError('unsupported image mode {}'.format(img.mode))
+        img = np.asarray(img)
+    if img.dtype != np.uint8 or not (
+            img.ndim == 2 or (img.ndim == 3 and img.shape[2] in (3, 4))):
+        raise ValueError('img must be HxW, HxWx3 or HxWx4 uint8 array')
+    alpha = img.ndim == 3 and img.shape[2] == 4
+    if fmt is None:
+        fmt = 'png' if alpha else 'jpg'
+    elif alpha and fmt.lower() in ('jpg', 'jpeg'):
+        raise ValueError('cannot write images with alpha as JPEG, '
+                         "use fmt='png'")
+    h, w = img.shape[:2]
+    save_kwargs = save_kwargs or {}
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+
+    if scheme == 'dzi':
+        max_level = int(math.ceil(math.log(max(w, h), 2)))
+        tiles_dir = os.path.join(out_dir, name + '_files')
+    else:
+        max_level = max(0, int(math.ceil(
+            math.log(float(max(w, h))/tile_size, 2))))
+        tiles_dir = out_dir
+        overlap = 0
+
+    workdir = None
+    if isinstance(img, np.memmap):
+        workdir = tempfile.mkdtemp(dir=out_dir if os.path.isdir(out_dir)
+                                   else None)
+
+    def save(level_img, path):
+        level_img.save(path, **save_kwargs)
+
+    try:
+        level = img
+        with ThreadPoolExecutor(num_threads) as pool:
+            for z in range(max_level, -1, -1):
+                lh, lw = level.shape[:2]
+                # bound the number of tiles waiting to be encoded
+                futures = deque()
+                for col, row, (t, l, b, r) in _tile_boxes(lh, lw, tile_size,
+                                                          overlap):
+                    if scheme == 'dzi':
+                        path = os.path.join(tiles_dir, str(z),
+                                            '{}_{}.{}'.format(col, row, fmt))
+                    else:
+                        path = os.path.join(tiles_dir, str(z), str(col),
+                                            '{}.{}'.format(row, fmt))
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    tile = np.ascontiguousarray(level[t:b, l:r])
+                    futures.append(pool.submit(save, array_to_image(tile),
+                                               path))
+                    if len(futures) > 4*num_threads:
+                        futures.popleft().result()
+                for f in futures:
+                    f.result()
+
+                if z > 0:
+                    shape = ((lh+1)//2, (lw+1)//2) + level.shape[2:]
+                    if workdir is not None:
+                        out = np.lib.format.open_memmap(
+                            os.path.join(workdir, '{}.npy'.format(z-1)),
+                            mode='w+', dtype=level.dtype, shape=shape)
+                    else:
+                        out = np.empty(shape, dtype=level.dtype)
+                    _halve(level, out)
+                    level = out
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if scheme == 'dzi':
+        dzi = os.path.join(out_dir, name + '.dzi')
+        with open(dzi, 'w') as f:
+            f.write(_DZI_TEMPLATE.format(fmt=fmt, overlap=overlap,
+                                         tile_size=tile_size,
+                                         width=w, height=h))
+        return dzi
+    return out_dir
+
+
+def montage_pyramid(images, layout, out_dir, mode='RGB', bg=None,
+                    resize_mode='center', border=0, border_color=None,
+                    **kwargs):
+    """ Render a montage band by band into a temporary memmap, and cut it
+    into a tile pyramid with `build_pyramid`. The montage never needs to
+    fit in memory.
+
+    :parameters:
+        - images: iterable of PIL images
+        - layout: MontageLayout
+        - out_dir: output directory
+        - mode, bg, resize_mode, border, border_color:
+            as in `write_montage`
+        - kwargs: passed to `build_pyramid`. Tiles of RGBA montages
+            default to png.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    workdir = tempfile.mkdtemp(dir=out_dir)
+    try:
+        sheet = write_montage(images, layout,
+                              os.path.join(workdir, 'montage.npy'),
+                              mode, bg, resize_mode, border, border_color,
+                              kwargs.get('num_threads'))
+        result = build_pyramid(sheet, out_dir, **kwargs)
+        del sheet
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+# relative imports need the package: python -m imgutils.pyramid
+if __name__ == '__main__':
+    import doctest
+    flags = doctest.REPORT_NDIFF
+    fail, total = doctest.testmod(optionflags=flags)
+    print("{} failures out of {} tests".format(fail, total))
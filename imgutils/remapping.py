@@ -1,83 +1,792 @@
 from collections import OrderedDict
-from PIL import Image
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import threading
+
 import numpy as np
 
 
-__all__ = ['rgb_image_to_label_image',
+__all__ = ['ColorLabelMap',
+           'LabelMap',
+           'clear_compile_cache',
+           'set_compile_cache_limits',
+           'rgb_image_to_label_image',
+           'rgb_images_to_label_images',
            'label_image_to_rgb_image',
-           'remap_labels']
+           'remap_labels',
+           'rgb_image_to_label_image_tiled',
+           'label_image_to_rgb_image_tiled',
+           'remap_labels_tiled']
+
+
+# 16777216 == 255*(2**16) + 255*(2**8) + 255 + 1 == 256**3
+_NUM_COLORS = 16777216
+
+# largest mapping for which a perfect hash is attempted, and the
+# largest hash table (in bits) we are willing to build for it.
+_HASH_MAX_KEYS = 1024
+_HASH_MAX_BITS = 16
+_HASH_NUM_TRIES = 64
+
+# largest dense color table engine='auto' builds, enough for 8-bit labels
+_DENSE_MAX_BYTES = _NUM_COLORS
+
+
+def _pack_rgb(img, out=None):
+    """ Pack HxWx3 uint8 colors into one uint32 per pixel, r<<16|g<<8|b.
+
+    Works in-place on `out`, so the only full-size array allocated
+    is the uint32 result itself. Other integer dtypes are accepted, as
+    long as their values are in (0, 255).
+    """
+    if img.dtype.kind not in 'iu':
+        raise ValueError('img must be an integer array, e.g. uint8')
+    if out is None:
+        out = np.empty(img.shape[:-1], dtype='uint32')
+    out[...] = img[..., 0]
+    out <<= 8
+    np.bitwise_or(out, img[..., 1], out=out, casting='unsafe')
+    out <<= 8
+    np.bitwise_or(out, img[..., 2], out=out, casting='unsafe')
+    return out
+
+
+def _pack_keys(colors):
+    colors = np.asarray(colors, dtype='uint32').reshape(-1, 3)
+    return (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+
+
+def _find_perfect_hash(keys):
+    """ Search for a multiplicative hash without collisions on `keys`.
+    Returns (multiplier, bits) or None.
+    """
+    # fixed seed so the same mapping always compiles to the same table
+    rng = np.random.RandomState(0)
+    min_bits = max(1, int(np.ceil(np.log2(max(len(keys), 2)))) + 1)
+    for bits in range(min_bits, _HASH_MAX_BITS+1):
+        shift = np.uint32(32 - bits)
+        mults = rng.randint(0, 2**31, _HASH_NUM_TRIES).astype('uint32')*2 + 1
+        for mult in mults:
+            h = (keys*mult) >> shift
+            if len(np.unique(h)) == len(keys):
+                return mult, bits
+    return None
+
+
+class ColorLabelMap(object):
+    """ Compiled (r, g, b) -> label lookup, built once and reused.
+
+    The mapping is compiled into one of three engines:
+
+        - 'hash': a small perfect-hash table, found at build time.
+          Fast and compact for mappings with up to a few hundred colors.
+        - 'sorted': sorted packed colors, looked up with searchsorted.
+          Compact for any number of colors, but slower per pixel.
+        - 'dense': a table with one entry per 24-bit color
+          (16M entries of `dtype`, e.g. 64MB for uint32). Fastest
+          lookup, about 15x faster per pixel than sorted.
+
+    With engine='auto' a hash is tried first. Without one, dense is used
+    if its table takes at most `max_dense_bytes`, and sorted otherwise.
+    The default only allows 8-bit dense tables; raise it, or ask for
+    engine='dense', when converting many pixels with the same mapping.
+    Instances are immutable after construction and can be shared
+    between threads.
+
+    :parameters:
+        - mapping: dictionary of (r,g,b) -> int
+        - default: label to use for colors not in mapping
+        - dtype: dtype of output label image
+        - engine: string
+            one of auto, hash, sorted, dense
+        - max_dense_bytes: int
+            largest dense table engine='auto' may build.
+
+    >>> cmap = ColorLabelMap({(255, 0, 0): 1, (0, 255, 0): 2}, dtype='uint8')
+    >>> img = np.zeros((2, 2, 3), dtype='uint8')
+    >>> img[0, 0] = (255, 0, 0)
+    >>> img[1, 1] = (0, 255, 0)
+    >>> cmap(img)
+    array([[1, 0],
+           [0, 2]], dtype=uint8)
+    >>> cmap.engine
+    'hash'
+    >>> ColorLabelMap(cmap.mapping, engine='sorted', default=7)(img)
+    array([[1, 7],
+           [7, 2]], dtype=uint32)
+    >>> many = dict(((i % 256, i // 256, 0), i % 7) for i in range(2000))
+    >>> ColorLabelMap(many).engine, ColorLabelMap(many, dtype='uint8').engine
+    ('sorted', 'dense')
+    """
+
+    def __init__(self, mapping, default=0, dtype='uint32', engine='auto',
+                 max_dense_bytes=_DENSE_MAX_BYTES):
+        if engine not in ('auto', 'hash', 'sorted', 'dense'):
+            raise ValueError('unknown engine')
+        self.mapping = dict(mapping)
+        self.default = default
+        self.dtype = np.dtype(dtype)
+
+        keys = _pack_keys(list(self.mapping.keys()))
+        values = np.array(list(self.mapping.values()), dtype=self.dtype)
+        order = np.argsort(keys)
+        keys, values = keys[order], values[order]
+
+        if engine in ('auto', 'hash'):
+            found = None
+            if len(keys) <= _HASH_MAX_KEYS:
+                found = _find_perfect_hash(keys)
+            if found is not None:
+                self._compile_hash(keys, values, *found)
+            elif engine == 'hash':
+                raise ValueError('no perfect hash found for mapping')
+            elif _NUM_COLORS*self.dtype.itemsize <= max_dense_bytes:
+                engine = 'dense'
+            else:
+                engine = 'sorted'
+        if engine == 'sorted':
+            self._compile_sorted(keys, values)
+        elif engine == 'dense':
+            self._compile_dense(keys, values)
+
+    def _compile_hash(self, keys, values, mult, bits):
+        self.engine = 'hash'
+        self._mult = mult
+        self._shift = np.uint32(32 - bits)
+        # keys outside the 24-bit range never match a packed pixel
+        self._hash_keys = np.full(2**bits, 0xffffffff, dtype='uint32')
+        self._hash_values = np.full(2**bits, self.default, dtype=self.dtype)
+        h = (keys*mult) >> self._shift
+        self._hash_keys[h] = keys
+        self._hash_values[h] = values
+
+    def _compile_sorted(self, keys, values):
+        self.engine = 'sorted'
+        # sentinel past the last color, so searchsorted never runs off
+        self._sorted_keys = np.append(keys, np.uint32(_NUM_COLORS))
+        self._sorted_values = np.append(
+            values, np.array([self.default], dtype=self.dtype))
+
+    def _compile_dense(self, keys, values):
+        self.engine = 'dense'
+        self._table = np.full(_NUM_COLORS, self.default, dtype=self.dtype)
+        self._table[keys] = values
+
+    @property
+    def nbytes(self):
+        """ memory used by the compiled tables """
+        if self.engine == 'hash':
+            return self._hash_keys.nbytes + self._hash_values.nbytes
+        elif self.engine == 'sorted':
+            return self._sorted_keys.nbytes + self._sorted_values.nbytes
+        return self._table.nbytes
+
+    def lookup_packed(self, packed, out=None):
+        """ Look up labels of colors already packed as r<<16|g<<8|b. """
+        if out is None:
+            out = np.empty(packed.shape, dtype=self.dtype)
+        elif out.shape != packed.shape or out.dtype != self.dtype:
+            raise ValueError('out must be {} array of shape {}'.format(
+                self.dtype, packed.shape))
+
+        if self.engine == 'dense':
+            np.take(self._table, packed, out=out)
+        elif self.engine == 'hash':
+            h = np.multiply(packed, self._mult)
+            h >>= self._shift
+            np.take(self._hash_values, h, out=out)
+            out[np.take(self._hash_keys, h) != packed] = self.default
+        else:
+            idx = np.searchsorted(self._sorted_keys, packed)
+            np.take(self._sorted_values, idx, out=out)
+            out[np.take(self._sorted_keys, idx) != packed] = self.default
+        return out
 
+    def __call__(self, img, out=None):
+        """ Map HxWx3 uint8 image to HxW label image.
 
-def rgb_image_to_label_image(img, mapping, default=0):
+        :parameters:
+            - img: HxWx3 uint8 image (numpy array)
+            - out: optional HxW array of `dtype` to write labels into
+        """
+        if img.ndim != 3 or img.shape[2] != 3:
+            raise ValueError('img must be HxWx3 matrix')
+        return self.lookup_packed(_pack_rgb(img), out=out)
+
+
+def rgb_image_to_label_image(img, mapping, default=0, out=None):
     """ Map RGB image to label image.
 
     :parameters:
         - img: HxWx3 uint8 image (numpy array)
-        - mapping: dictionary of (r,g,b) -> int
+        - mapping: dictionary of (r,g,b) -> int, or a ColorLabelMap.
+          For repeated calls, build the ColorLabelMap once and pass it.
         - default: label to use for keys not in mapping
+          (ignored if mapping is a ColorLabelMap)
+        - out: optional HxW array to write labels into
+
+    >>> img = np.zeros((1, 2, 3), dtype='uint8')
+    >>> img[0, 1] = (1, 2, 3)
+    >>> rgb_image_to_label_image(img, {(1, 2, 3): 4})
+    array([[0, 4]], dtype=uint32)
+    >>> rgb_image_to_label_image(np.array([[[1, 2, 3]]]), {(1, 2, 3): 4})
+    array([[4]], dtype=uint32)
     """
-    if img.ndim != 3:
-        raise ValueError('img must be HxWx3 matrix')
-    if img.shape[2] != 3:
-        raise ValueError('img must be HxWx3 matrix')
+    mapping = _compiled(ColorLabelMap, mapping, default=default)
+    return mapping(img, out=out)
+
+
+def _rgb_rows_to_labels(cmap, img, out, chunk_pixels, local):
+    """ Convert HxWx3 `img` into `out` in blocks of rows, packing each
+    block into a per-thread uint32 scratch buffer.
+    """
+    rows = max(1, chunk_pixels // max(1, img.shape[1]))
+    size = rows*img.shape[1]
+    scratch = getattr(local, 'scratch', None)
+    if scratch is None or scratch.size < size:
+        scratch = local.scratch = np.empty(size, dtype='uint32')
+    for r0 in range(0, img.shape[0], rows):
+        block = img[r0:r0+rows]
+        packed = scratch[:block.shape[0]*block.shape[1]]
+        packed = packed.reshape(block.shape[:2])
+        _pack_rgb(block, out=packed)
+        cmap.lookup_packed(packed, out=out[r0:r0+rows])
+    return out
+
+
+def rgb_images_to_label_images(images, mapping, default=0, dtype='uint32',
+                               out=None, num_threads=None,
+                               chunk_pixels=65536):
+    """ Map a batch of RGB images to label images, in parallel.
+
+    Each image is processed in blocks of about `chunk_pixels` pixels,
+    so color packing only ever needs one small uint32 buffer per thread.
+
+    :parameters:
+        - images: NxHxWx3 uint8 array, or iterable of HxWx3 uint8 arrays
+        - mapping: dictionary of (r,g,b) -> int, or a ColorLabelMap
+        - default: label to use for keys not in mapping
+          (ignored if mapping is a ColorLabelMap)
+        - dtype: dtype of label images (ignored if mapping is a ColorLabelMap)
+        - out: optional NxHxW array to write labels into.
+          Only used for array input.
+        - num_threads: int
+            number of worker threads, defaults to number of cpus.
+        - chunk_pixels: int
+            approximate number of pixels converted at a time per thread.
+
+    :returns:
+        NxHxW array for array input. For any other iterable, an iterator
+        over label images, in input order.
+
+    >>> imgs = np.zeros((2, 1, 2, 3), dtype='uint8')
+    >>> imgs[1, 0, 1] = (1, 2, 3)
+    >>> rgb_images_to_label_images(imgs, {(1, 2, 3): 4}, dtype='uint8')
+    array([[[0, 0]],
+    <BLANKLINE>
+           [[0, 4]]], dtype=uint8)
+    >>> [l.tolist() for l in rgb_images_to_label_images(iter(imgs),
+    ...                                                 {(1, 2, 3): 4})]
+    [[[0, 0]], [[0, 4]]]
+    """
+    mapping = _compiled(ColorLabelMap, mapping, default=default, dtype=dtype)
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+
+    if isinstance(images, np.ndarray):
+        return _rgb_stack_to_labels(images, mapping, out, num_threads,
+                                    chunk_pixels)
+    return _rgb_iter_to_labels(images, mapping, num_threads, chunk_pixels)
 
-    img2 = img.astype('uint32')
 
-    # assign a unique integer to each (r, g, b) tuple
-    rshift = img2[:,:,0]<<16
-    gshift = img2[:,:,1]<<8
-    bshift = img2[:,:,2]
-    imgh = np.bitwise_or(np.bitwise_or(rshift, gshift), bshift)
+def _rgb_stack_to_labels(images, cmap, out, num_threads, chunk_pixels):
+    if images.ndim != 4 or images.shape[3] != 3:
+        raise ValueError('images must be NxHxWx3 array')
+    n, h = images.shape[:2]
+    if out is None:
+        out = np.empty(images.shape[:3], dtype=cmap.dtype)
+    elif out.shape != images.shape[:3] or out.dtype != cmap.dtype:
+        raise ValueError('out must be {} array of shape {}'.format(
+            cmap.dtype, images.shape[:3]))
 
-    # create a big table with one entry for each 256**3-1 colors
-    # 16777216 == 255*(2**16) + 255*(2**8) + 255 + 1 == 256**3
-    rgb_tab = np.zeros(16777216, dtype='uint32')
-    if default != 0:
-        rgb_tab.fill(default)
+    # split images into row bands when there are fewer images than threads
+    bands = max(1, min(h, num_threads // max(1, n)))
+    band_h = int(math.ceil(float(h)/bands))
+    tasks = [(i, r0, min(h, r0+band_h))
+             for i in range(n) for r0 in range(0, h, band_h)]
 
-    # fill table with labels in mapping
-    for k, v in mapping.iteritems():
-        hk = k[0]*(2**16) + k[1]*(2**8) + k[2]
-        rgb_tab[hk] = v
+    local = threading.local()
 
-    # take() is slightly faster
-    # limg2 = rgb_tab[imgh]
-    limg2 = np.take(rgb_tab, imgh)
-    return limg2
+    def work(task):
+        i, r0, r1 = task
+        _rgb_rows_to_labels(cmap, images[i, r0:r1], out[i, r0:r1],
+                            chunk_pixels, local)
+
+    if num_threads <= 1 or len(tasks) == 1:
+        for task in tasks:
+            work(task)
+    else:
+        with ThreadPoolExecutor(num_threads) as pool:
+            for _ in pool.map(work, tasks):
+                pass
+    return out
+
+
+def _rgb_iter_to_labels(images, cmap, num_threads, chunk_pixels):
+    local = threading.local()
+
+    def work(img):
+        if img.ndim != 3 or img.shape[2] != 3:
+            raise ValueError('img must be HxWx3 matrix')
+        out = np.empty(img.shape[:2], dtype=cmap.dtype)
+        return _rgb_rows_to_labels(cmap, img, out, chunk_pixels, local)
+
+    # keep a bounded number of frames in flight, yield in input order
+    max_in_flight = 2*num_threads
+    with ThreadPoolExecutor(num_threads) as pool:
+        pending = deque()
+        for img in images:
+            pending.append(pool.submit(work, img))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# label ranges up to this size always get a dense table
+_DENSE_MIN_SPAN = 65536
+# otherwise, dense tables may be at most this many times the number of keys
+_DENSE_MAX_FILL = 8
+
+# the compile cache holds at most this many maps, and this many bytes
+# of tables (though always at least the newest map, unless disabled).
+# see set_compile_cache_limits
+_COMPILE_CACHE_SIZE = 32
+_COMPILE_CACHE_BYTES = 2**26
+_compile_cache = OrderedDict()
+_compile_lock = threading.Lock()
+
+
+def clear_compile_cache():
+    """ Drop all maps compiled from plain dicts and lists, freeing their
+    tables. They are rebuilt on next use.
+    """
+    with _compile_lock:
+        _compile_cache.clear()
+
+
+def set_compile_cache_limits(max_maps=None, max_bytes=None):
+    """ Change how many compiled maps, and how many bytes of their
+    tables, are kept for reuse between calls with equal mappings.
+    None leaves a limit as it is; max_maps=0 disables the cache.
+
+    Returns the previous (max_maps, max_bytes).
+
+    >>> old = set_compile_cache_limits(max_bytes=2**20)
+    >>> set_compile_cache_limits(*old)
+    (32, 1048576)
+    """
+    global _COMPILE_CACHE_SIZE, _COMPILE_CACHE_BYTES
+    with _compile_lock:
+        old = _COMPILE_CACHE_SIZE, _COMPILE_CACHE_BYTES
+        if max_maps is not None:
+            _COMPILE_CACHE_SIZE = max_maps
+        if max_bytes is not None:
+            _COMPILE_CACHE_BYTES = max_bytes
+        _trim_compile_cache()
+    return old
 
 
-def label_image_to_rgb_image(label_img, mapping, default=[255, 255, 255]):
+def _trim_compile_cache():
+    if not _COMPILE_CACHE_SIZE:
+        _compile_cache.clear()
+    while len(_compile_cache) > 1 and (
+            len(_compile_cache) > _COMPILE_CACHE_SIZE or
+            sum(c.nbytes for c in _compile_cache.values()) >
+            _COMPILE_CACHE_BYTES):
+        _compile_cache.popitem(last=False)
+
+
+def _freeze(x):
+    if isinstance(x, dict):
+        return frozenset((k, _freeze(v)) for k, v in x.items())
+    if isinstance(x, np.ndarray):
+        return _freeze(x.tolist())
+    if isinstance(x, tuple):
+        try:
+            # already hashable, e.g. a color
+            hash(x)
+            return x
+        except TypeError:
+            pass
+    if isinstance(x, (list, tuple)):
+        return tuple(_freeze(v) for v in x)
+    return x
+
+
+def _compiled(cls, mapping, **kwargs):
+    """ Compile `mapping` with `cls`, reusing a previous compilation
+    of an equal mapping if there is one in the (small) LRU cache.
+    """
+    if isinstance(mapping, cls):
+        return mapping
+    key = (cls, _freeze(mapping),
+           tuple(sorted((k, _freeze(v)) for k, v in kwargs.items())))
+    with _compile_lock:
+        compiled = _compile_cache.pop(key, None)
+        if compiled is not None:
+            _compile_cache[key] = compiled
+            return compiled
+    compiled = cls(mapping, **kwargs)
+    with _compile_lock:
+        _compile_cache[key] = compiled
+        _trim_compile_cache()
+    return compiled
+
+
+def _smallest_dtype(values, default):
+    """ smallest integer dtype holding all of `values` and `default` """
+    scalars = np.concatenate([np.ravel(values), np.ravel(default)])
+    lo, hi = int(scalars.min()), int(scalars.max())
+    if lo >= 0:
+        return np.min_scalar_type(hi)
+    return np.result_type(np.min_scalar_type(lo), np.min_scalar_type(-hi-1))
+
+
+class LabelMap(object):
+    """ Compiled int -> value lookup for label images.
+
+    Values may be ints (label -> label) or fixed-length sequences,
+    e.g. (r, g, b) colors. Two engines are used:
+
+        - 'dense': a table indexed by label. Chosen when the key range is
+          small compared to the number of keys.
+          Inputs of 8 and 16 bit integer types always use a dense table
+          covering their whole range, built on first use.
+        - 'sparse': sorted keys looked up with searchsorted. Used for
+          sparse or huge keys, e.g. instance ids in the millions.
+
+    Negative keys are supported by both engines.
+
+    :parameters:
+        - mapping: dictionary of int -> int or int -> sequence
+        - default: value for labels not in mapping
+        - dtype: output dtype. If None, the smallest
+          dtype that holds all values and the default.
+
+    >>> lm = LabelMap({-1: 0, 3: 1, 10**7: 2})
+    >>> lm.engine, lm.dtype
+    ('sparse', dtype('int8'))
+    >>> lm(np.array([[-1, 3], [10**7, 5]]))
+    array([[ 0,  1],
+           [ 2, -1]], dtype=int8)
+    >>> lm(np.array([3, 4], dtype='uint8'))
+    array([ 1, -1], dtype=int8)
+    """
+
+    def __init__(self, mapping, default=-1, dtype=None):
+        self.mapping = dict(mapping)
+        keys = np.array(list(self.mapping.keys()), dtype='int64')
+        values = np.array(list(self.mapping.values()))
+        if dtype is None:
+            dtype = _smallest_dtype(values, default)
+        self.dtype = np.dtype(dtype)
+        self.default = default
+
+        order = np.argsort(keys)
+        self._keys = keys[order]
+        self._values = np.asarray(values[order], dtype=self.dtype)
+        self.value_shape = self._values.shape[1:]
+        self._default = np.empty(self.value_shape, dtype=self.dtype)
+        self._default[...] = default
+        # dense tables for small input dtypes, keyed by dtype
+        self._range_tables = {}
+
+        if len(keys):
+            self._lo = int(self._keys[0])
+            span = int(self._keys[-1]) - self._lo + 1
+        else:
+            self._lo, span = 0, 0
+        if span <= max(_DENSE_MIN_SPAN, _DENSE_MAX_FILL*len(keys)):
+            self.engine = 'dense'
+            self._table = self._make_table(self._lo, span)
+        else:
+            self.engine = 'sparse'
+
+    def _make_table(self, lo, span):
+        """ table with entry i holding the value of label lo+i """
+        table = np.empty((span,) + self.value_shape, dtype=self.dtype)
+        table[...] = self._default
+        inside = (self._keys >= lo) & (self._keys < lo+span)
+        table[self._keys[inside] - lo] = self._values[inside]
+        return table
+
+    def _range_table(self, dtype):
+        table = self._range_tables.get(dtype)
+        if table is None:
+            info = np.iinfo(dtype)
+            # rotate so that negative labels are found with python-style
+            # negative indexing, e.g. -1 at table[-1]
+            table = self._make_table(info.min, info.max - info.min + 1)
+            table = np.roll(table, info.min, axis=0)
+            self._range_tables[dtype] = table
+        return table
+
+    def _fits(self, dtype):
+        """ whether all values and the default can be cast to dtype
+        without changing them
+        """
+        if np.can_cast(self.dtype, dtype):
+            return True
+        if dtype.kind not in 'iu' or self.dtype.kind not in 'iu':
+            return False
+        scalars = np.concatenate([self._values.ravel(),
+                                  self._default.ravel()])
+        info = np.iinfo(dtype)
+        return info.min <= int(scalars.min()) and \
+            int(scalars.max()) <= info.max
+
+    @property
+    def nbytes(self):
+        """ memory used by the compiled tables """
+        nbytes = self._keys.nbytes + self._values.nbytes
+        if self.engine == 'dense':
+            nbytes += self._table.nbytes
+        return nbytes + sum(t.nbytes for t in self._range_tables.values())
+
+    def __call__(self, label_img, out=None):
+        """ Look up the value of every label in `label_img`.
+
+        :parameters:
+            - label_img: int image
+            - out: optional array to write into. May be `label_img`
+              itself, for in-place remapping. If its dtype differs from
+              `dtype`, values are cast to it, and ValueError is raised if
+              any value or the default does not fit.
+        """
+        label_img = np.asarray(label_img)
+        shape = label_img.shape + self.value_shape
+        if out is None:
+            out = np.empty(shape, dtype=self.dtype)
+        elif out.shape != shape:
+            raise ValueError('out must have shape {}'.format(shape))
+        elif not self._fits(out.dtype):
+            raise ValueError('values and default do not fit in out of '
+                             'dtype {}'.format(out.dtype))
+
+        dtype = label_img.dtype
+        if dtype.kind in 'iu' and dtype.itemsize <= 2:
+            _take(self._range_table(dtype), label_img, out)
+            return out
+
+        if not len(self._keys):
+            out[...] = self._default
+            return out
+
+        # find misses before writing, since out may be label_img
+        if self.engine == 'dense':
+            idx = np.subtract(label_img, self._lo, dtype='int64')
+            miss = (idx < 0) | (idx >= len(self._table))
+            idx[miss] = 0
+            table = self._table
+        else:
+            idx = np.searchsorted(self._keys, label_img)
+            np.minimum(idx, len(self._keys)-1, out=idx)
+            miss = np.take(self._keys, idx) != label_img
+            table = self._values
+        _take(table, idx, out)
+        out[miss] = self._default
+        return out
+
+
+def _take(table, idx, out):
+    # tables are small, so casting them is cheaper than casting the output
+    if out.dtype != table.dtype:
+        table = table.astype(out.dtype)
+    np.take(table, idx, axis=0, out=out)
+
+
+def label_image_to_rgb_image(label_img, mapping, default=[255, 255, 255],
+                             out=None):
     """ Map integer label image to rgb image.
 
     :parameters:
         - label_img: int image
-        - mapping: dictionary of int -> (r, g, b)
-        - default: default rgb
+        - mapping: dictionary of int -> (r, g, b), or a LabelMap.
+          Cached like in `remap_labels`.
+        - default: default rgb (ignored if mapping is a LabelMap)
+        - out: optional HxWx3 uint8 array to write into
+
+    >>> label_image_to_rgb_image(np.array([[0, 7]]), {7: (1, 2, 3)})
+    array([[[255, 255, 255],
+            [  1,   2,   3]]], dtype=uint8)
     """
-    lbl_max = np.max(mapping.keys())
-    label_tab = np.empty((lbl_max+1, 3), dtype='u1')
-    label_tab[:] = default
-    for lbl_src, lbl_dst in mapping.iteritems():
-        label_tab[lbl_src] = lbl_dst
-    return label_tab[label_img]
+    mapping = _compiled(LabelMap, mapping, default=default, dtype='uint8')
+    return mapping(label_img, out=out)
 
 
-def remap_labels(label_img, mapping, default=-1):
+def remap_labels(label_img, mapping, default=-1, dtype=None, out=None):
     """ Map integer labels to integer labels.
 
     :parameters:
         - label_img: int image
-        - mapping: dictionary of int -> int
-        - default: default int
+        - mapping: dictionary of int -> int, or a LabelMap.
+          Dictionaries are compiled once and kept in a shared cache for
+          later calls, see `set_compile_cache_limits`.
+        - default: default int (ignored if mapping is a LabelMap)
+        - dtype: output dtype. If None, the smallest dtype that holds
+          all values and the default (ignored if mapping is a LabelMap).
+        - out: optional array to write into. May be `label_img`
+          itself, for in-place remapping.
+
+    >>> img = np.array([[0, 1], [2, 3]], dtype='uint8')
+    >>> remap_labels(img, {0: 10, 1: 11}, default=0)
+    array([[10, 11],
+           [ 0,  0]], dtype=uint8)
+    >>> _ = remap_labels(img, {0: 10, 1: 11}, default=0, out=img)
+    >>> img
+    array([[10, 11],
+           [ 0,  0]], dtype=uint8)
+    """
+    mapping = _compiled(LabelMap, mapping, default=default, dtype=dtype)
+    return mapping(label_img, out=out)
+
+
+# default budget for one block of a tiled conversion, input plus output
+_TILE_BYTES = 2**24
+
+
+def _open_input(src):
+    """ arrays and memmaps are used as-is, paths are mapped read-only """
+    if isinstance(src, np.ndarray):
+        return src
+    return np.load(src, mmap_mode='r')
+
+
+def _open_output(out, shape, dtype):
+    """ arrays and memmaps are used as-is, paths become .npy memmaps """
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if isinstance(out, np.ndarray):
+        if out.shape != shape:
+            raise ValueError('out must have shape {}'.format(shape))
+        return out
+    return np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+
+
+def _iter_tiles(shape, pixel_bytes, tile_bytes):
+    """ Yield (rows, cols) slices covering the first two dims of `shape`.
+    Tiles span whole rows when possible, to read files sequentially.
+    """
+    h, w = shape[:2]
+    row_bytes = max(1, w*pixel_bytes)
+    if row_bytes <= tile_bytes:
+        tile_h, tile_w = max(1, tile_bytes // row_bytes), w
+    else:
+        tile_h, tile_w = 1, max(1, tile_bytes // pixel_bytes)
+    for r0 in range(0, h, tile_h):
+        for c0 in range(0, w, tile_w):
+            yield slice(r0, r0+tile_h), slice(c0, c0+tile_w)
+
+
+def _map_tiled(func, src, out, shape, dtype, tile_bytes):
+    src = _open_input(src)
+    shape = src.shape[:2] + shape
+    out = _open_output(out, shape, dtype)
+    pixel_bytes = (src.itemsize*int(np.prod(src.shape[2:])) +
+                   out.itemsize*int(np.prod(out.shape[2:])))
+    for rows, cols in _iter_tiles(src.shape, pixel_bytes, tile_bytes):
+        func(src[rows, cols], out=out[rows, cols])
+    if hasattr(out, 'flush'):
+        out.flush()
+    return out
+
+
+def rgb_image_to_label_image_tiled(img, mapping, out=None, default=0,
+                                   dtype='uint32', tile_bytes=_TILE_BYTES):
+    """ Map RGB image to label image, one tile at a time.
+
+    For images that do not fit in memory. Peak memory is bounded by
+    `tile_bytes` (plus the compiled mapping), not the image size.
+
+    :parameters:
+        - img: HxWx3 uint8 array, np.memmap, or path to a .npy file
+        - mapping: dictionary of (r,g,b) -> int, or a ColorLabelMap
+        - out: HxW array or np.memmap, or path of a .npy file to create.
+          If None, a new in-memory array.
+        - default: label to use for keys not in mapping
+          (ignored if mapping is a ColorLabelMap)
+        - dtype: dtype of label image (ignored if mapping is a ColorLabelMap)
+        - tile_bytes: int
+            approximate input plus output bytes per tile
+
+    >>> import os, tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> img = np.zeros((4, 3, 3), dtype='uint8')
+    >>> img[3, 2] = (1, 2, 3)
+    >>> np.save(os.path.join(d, 'rgb.npy'), img)
+    >>> lbl = rgb_image_to_label_image_tiled(
+    ...     os.path.join(d, 'rgb.npy'), {(1, 2, 3): 4},
+    ...     out=os.path.join(d, 'lbl.npy'), dtype='uint8', tile_bytes=8)
+    >>> np.load(os.path.join(d, 'lbl.npy'))[3]
+    array([0, 0, 4], dtype=uint8)
+    """
+    mapping = _compiled(ColorLabelMap, mapping, default=default, dtype=dtype)
+    return _map_tiled(mapping, img, out, (), mapping.dtype, tile_bytes)
+
+
+def label_image_to_rgb_image_tiled(label_img, mapping, out=None,
+                                   default=[255, 255, 255],
+                                   tile_bytes=_TILE_BYTES):
+    """ Map integer label image to rgb image, one tile at a time.
+
+    :parameters:
+        - label_img: int array, np.memmap, or path to a .npy file
+        - mapping: dictionary of int -> (r, g, b), or a LabelMap
+        - out: HxWx3 array or np.memmap, or path of a .npy file to create.
+          If None, a new in-memory array.
+        - default: default rgb (ignored if mapping is a LabelMap)
+        - tile_bytes: int
+            approximate input plus output bytes per tile
+
+    >>> label_image_to_rgb_image_tiled(np.array([[0, 7]]), {7: (1, 2, 3)},
+    ...                                tile_bytes=1)
+    array([[[255, 255, 255],
+            [  1,   2,   3]]], dtype=uint8)
+    """
+    mapping = _compiled(LabelMap, mapping, default=default, dtype='uint8')
+    return _map_tiled(mapping, label_img, out, mapping.value_shape,
+                      mapping.dtype, tile_bytes)
+
+
+def remap_labels_tiled(label_img, mapping, out=None, default=-1, dtype=None,
+                       tile_bytes=_TILE_BYTES):
+    """ Map integer labels to integer labels, one tile at a time.
+
+    :parameters:
+        - label_img: int array, np.memmap, or path to a .npy file
+        - mapping: dictionary of int -> int, or a LabelMap
+        - out: array or np.memmap, or path of a .npy file to create.
+          May be `label_img` itself (opened with mode 'r+') for in-place
+          remapping. If None, a new in-memory array.
+        - default: default int (ignored if mapping is a LabelMap)
+        - dtype: output dtype. If None, the smallest dtype that holds
+          all values and the default (ignored if mapping is a LabelMap).
+        - tile_bytes: int
+            approximate input plus output bytes per tile
+
+    >>> remap_labels_tiled(np.arange(6).reshape(2, 3), {5: 1}, tile_bytes=4)
+    array([[-1, -1, -1],
+           [-1, -1,  1]], dtype=int8)
     """
-    lbl_max = np.max(mapping.keys())
-    label_tab = np.empty((lbl_max+1), dtype='int64')
-    label_tab.fill(default)
-    for lbl_src, lbl_dst in mapping.iteritems():
-        label_tab[lbl_src] = lbl_dst
-    return label_tab[label_img]
+    mapping = _compiled(LabelMap, mapping, default=default, dtype=dtype)
+    return _map_tiled(mapping, label_img, out, mapping.value_shape,
+                      mapping.dtype, tile_bytes)
 
 
+# relative imports need the package: python -m imgutils.remapping
 if __name__ == '__main__':
     import doctest
     flags = doctest.REPORT_NDIFF
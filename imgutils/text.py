@@ -0,0 +1,213 @@
+
+__all__ = ['TextAtlas',
+           'draw_labels',
+           'draw_tiny_text',
+           'get_text_atlas']
+
+
+from collections import OrderedDict
+import threading
+
+import numpy as np
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+from .np_pil_interop import array_to_image
+from .np_pil_interop import image_to_array
+
+
+_atlases = {}
+_atlases_lock = threading.Lock()
+
+
+def _load_font(font, size):
+    if font is None:
+        if size is None:
+            return ImageFont.load_default()
+        return ImageFont.load_default(size)
+    if not isinstance(font, str):
+        return font
+    if font.endswith('.pil'):
+        return ImageFont.load(font)
+    return ImageFont.truetype(font, size or 10)
+
+
+class TextAtlas(object):
+    """ Cache of rendered text masks for one font.
+
+    Each distinct string is rasterized once, the first time it is drawn;
+    afterwards it is blended onto images straight from the cached mask.
+    Meant for annotations that repeat a small set of strings, like
+    class names.
+
+    :parameters:
+        - font: None for PIL's default font, path of a .pil bitmap
+          font or a truetype font, or a PIL font object
+        - size: int
+            font size, for truetype fonts
+        - max_entries: int
+            most strings kept, least recently used are evicted first
+
+    >>> atlas = TextAtlas()
+    >>> arr = np.zeros((20, 40), dtype='uint8')
+    >>> atlas.draw(arr, 'cat', (1, 1), 255)
+    >>> bool(arr.any()), 'cat' in atlas
+    (True, True)
+    """
+
+    def __init__(self, font=None, size=None, max_entries=1024):
+        self.font = _load_font(font, size)
+        self.max_entries = max_entries
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, text):
+        return text in self._masks
+
+    def __len__(self):
+        return len(self._masks)
+
+    def mask(self, text):
+        """ (mask, (dx, dy)): uint8 coverage of `text` and its offset from
+        the text position.
+        """
+        with self._lock:
+            entry = self._masks.pop(text, None)
+            if entry is not None:
+                self._masks[text] = entry
+                return entry
+        left, top, right, bottom = self.font.getbbox(text)
+        canvas = Image.new('L', (max(1, right), max(1, bottom)))
+        ImageDraw.Draw(canvas).text((0, 0), text, fill=255, font=self.font)
+        mask = np.asarray(canvas)[top:bottom, left:right]
+        entry = (mask, (left, top))
+        with self._lock:
+            self._masks[text] = entry
+            while len(self._masks) > self.max_entries:
+                self._masks.popitem(last=False)
+        return entry
+
+    def text_size(self, text):
+        """ width, height of the rendered text """
+        mask, (dx, dy) = self.mask(text)
+        return dx + mask.shape[1], dy + mask.shape[0]
+
+    def draw(self, arr, text, pos, color):
+        """ Blend `text` onto HxW(xC) array `arr` in-place, at pos (x, y)
+        from the top left. Clipped to the array.
+        """
+        mask, (dx, dy) = self.mask(text)
+        x, y = int(pos[0]) + dx, int(pos[1]) + dy
+        h, w = arr.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + mask.shape[1], w), min(y + mask.shape[0], h)
+        if x0 >= x1 or y0 >= y1:
+            return
+        m = mask[y0-y:y1-y, x0-x:x1-x].astype('uint16')
+        region = arr[y0:y1, x0:x1]
+        if region.ndim == 3:
+            m = m[..., np.newaxis]
+        color = np.asarray(color, dtype='uint16')
+        region[...] = (region*(255 - m) + color*m + 127) // 255
+
+    def draw_many(self, arr, texts, positions, colors):
+        """ Blend several strings onto `arr`. `colors` is one color
+        or one per string.
+        """
+        colors = np.asarray(colors)
+        if colors.ndim == arr.ndim - 2:
+            colors = np.broadcast_to(colors, (len(texts),) + colors.shape)
+        for text, pos, color in zip(texts, positions, colors):
+            self.draw(arr, text, pos, color)
+
+
+def get_text_atlas(font=None, size=None):
+    """ Shared TextAtlas for a font, loaded once per process. """
+    key = (font, size) if font is None or isinstance(font, str) else \
+        (id(font), size)
+    with _atlases_lock:
+        atlas = _atlases.get(key)
+        if atlas is None:
+            atlas = _atlases[key] = TextAtlas(font, size)
+    return atlas
+
+
+def _draw_on(img, func):
+    """ call func with a writable array of img, writing back if needed """
+    if not isinstance(img, Image.Image):
+        func(img)
+        return
+    try:
+        func(image_to_array(img, writable=True, allow_copy=False))
+    except ValueError:
+        arr = np.array(img)
+        func(arr)
+        img.paste(array_to_image(arr), (0, 0))
+
+
+def draw_tiny_text(img, text, pos, color, font=None, size=None):
+    """
+    draws tiny text on image, in-place.
+
+    :parameters:
+        - img: PIL image or HxW(xC) ndarray
+        - text: string
+        - pos: tuple (int, int)
+            x, y position of text from top left
+        - color: int or tuple of ints
+        - font: font for `get_text_atlas`. Default is PIL's default font.
+        - size: font size, for truetype fonts
+
+    >>> img = Image.new('RGB', (40, 20))
+    >>> draw_tiny_text(img, 'dog', (2, 2), (255, 255, 0))
+    >>> img.getbbox() is not None
+    True
+    """
+    atlas = get_text_atlas(font, size)
+    _draw_on(img, lambda arr: atlas.draw(arr, text, pos, color))
+
+
+def draw_labels(img, boxes, labels, colors=None, bg=None, font=None,
+                size=None):
+    """ Draw one label per bounding box, in-place.
+
+    Labels are placed just above the top left corner of each box, or
+    just inside it when there is no room above.
+
+    :parameters:
+        - img: PIL image or HxW(xC) ndarray
+        - boxes: (N, 4) array of x0, y0, x1, y1, as in `draw_bboxes`
+        - labels: sequence of N strings
+        - colors: text color, one or one per label.
+          Default is white.
+        - bg: optional color of a filled background behind each label,
+          one or one per label.
+        - font, size: as in `draw_tiny_text`
+
+    >>> arr = np.zeros((50, 50, 3), dtype='uint8')
+    >>> draw_labels(arr, [[5, 20, 30, 40]], ['car'], bg=(255, 0, 0))
+    >>> on_bg = (arr[:20] == (255, 0, 0)).all(axis=2)
+    >>> bool(on_bg.any()), bool(arr[20:].any())
+    (True, False)
+    """
+    atlas = get_text_atlas(font, size)
+    boxes = np.asarray(boxes, dtype='int64').reshape(-1, 4)
+
+    def draw(arr):
+        channels = arr.shape[2:]
+        text_colors = colors
+        if text_colors is None:
+            text_colors = np.full(channels, 255, dtype='uint8')
+        positions = []
+        for (x0, y0, _, _), label in zip(boxes.tolist(), labels):
+            w, h = atlas.text_size(label)
+            y = y0 - h if y0 - h >= 0 else y0
+            positions.append((x0, y))
+            if bg is not None:
+                fill = bg if np.ndim(bg) == len(channels) else \
+                    bg[len(positions)-1]
+                arr[max(y, 0):max(y+h, 0), max(x0, 0):max(x0+w, 0)] = fill
+        atlas.draw_many(arr, labels, positions, text_colors)
+
+    _draw_on(img, draw)
@@ -1,25 +1,127 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""Tests for `imgutils` package."""
+"""Tests for `imgutils` package.
+
+Most functions are tested by their doctests, which py.test also
+collects (see setup.cfg). These cover the package namespace.
+"""
+
+import importlib
+import os
 
 import pytest
 
+import imgutils
+
+
+_PACKAGE_DIR = os.path.dirname(imgutils.__file__)
+_SUBMODULES = sorted(f[:-3] for f in os.listdir(_PACKAGE_DIR)
+                     if f.endswith('.py') and f != '__init__.py')
+
+
+def test_every_submodule_is_listed():
+    assert sorted(imgutils._SUBMODULE_NAMES) == _SUBMODULES
+
+
+@pytest.mark.parametrize('module', _SUBMODULES)
+def test_lazy_names_match_all(module):
+    names = imgutils._SUBMODULE_NAMES[module]
+    if not names:
+        # deliberately not re-exported, e.g. aio
+        return
+    exported = importlib.import_module('imgutils.' + module).__all__
+    assert sorted(names) == sorted(exported)
+
+
+def test_lazy_names_resolve():
+    for name in imgutils.__all__:
+        value = getattr(imgutils, name)
+        module = imgutils._NAME_TO_SUBMODULE[name]
+        assert value is getattr(
+            importlib.import_module('imgutils.' + module), name)
+
+
+def test_unknown_name():
+    with pytest.raises(AttributeError):
+        imgutils.no_such_function
+
+
+def test_instrument_disable_restores_package_names():
+    from PIL import Image
+    from imgutils import instrument, pil_utils
+    img = Image.new('L', (8, 8))
+    imgutils.__dict__.pop('crop_center', None)
+    with instrument.instrumented(['crop_center']):
+        # first lookup through the package caches the wrapper there
+        imgutils.crop_center(img, (4, 4))
+    assert imgutils.crop_center is pil_utils.crop_center
+    imgutils.crop_center(img, (4, 4))
+    assert instrument.get_stats()['crop_center']['calls'] == 1
+    instrument.reset_stats()
+
+
+def test_instrument_reset_keeps_callbacks():
+    from imgutils import instrument
+    seen = []
+
+    def record(name, *metrics):
+        seen.append(name)
+    instrument.add_callback(record)
+    try:
+        instrument.reset_stats()
+        with instrument.instrumented(['center_box']):
+            imgutils.center_box((8, 8), (4, 4))
+    finally:
+        instrument.remove_callback(record)
+        instrument.reset_stats()
+    assert seen == ['center_box']
 
-from imgutils import imgutils
 
+def test_compile_cache_limits():
+    import numpy as np
+    from imgutils import remapping
+    img = np.array([[0, 1]], dtype='uint8')
+    old = remapping.set_compile_cache_limits(max_maps=0)
+    try:
+        remapping.remap_labels(img, {0: 5})
+        assert not remapping._compile_cache
+        remapping.set_compile_cache_limits(max_maps=4)
+        remapping.remap_labels(img, {0: 5})
+        assert len(remapping._compile_cache) == 1
+        remapping.clear_compile_cache()
+        assert not remapping._compile_cache
+    finally:
+        remapping.set_compile_cache_limits(*old)
 
-@pytest.fixture
-def response():
-    """Sample pytest fixture.
 
-    See more at: http://doc.pytest.org/en/latest/fixture.html
-    """
-    # import requests
-    # return requests.get('https://github.com/audreyr/cookiecutter-pypackage')
+def test_remap_labels_out_dtype_overflow():
+    import numpy as np
+    from imgutils import remapping
+    img = np.array([[0, 1, 2]], dtype='uint8')
+    # 300 and the default -1 do not fit in uint8
+    with pytest.raises(ValueError):
+        remapping.remap_labels(img, {0: 10, 1: 300}, out=img)
+    with pytest.raises(ValueError):
+        remapping.remap_labels(img, {0: 10, 1: 30}, out=img)
+    assert img.tolist() == [[0, 1, 2]]
+    out = remapping.remap_labels(img, {0: 10, 1: 30}, default=0, out=img)
+    assert out.tolist() == [[10, 30, 0]]
 
 
-def test_content(response):
-    """Sample pytest test function with the pytest fixture as an argument."""
-    # from bs4 import BeautifulSoup
-    # assert 'GitHub' in BeautifulSoup(response.content).title.string
+def test_instrument_counts_calls_between_submodules():
+    from PIL import Image
+    from imgutils import compositing, instrument, pil_utils
+    images = [Image.new('RGB', (16, 8)), Image.new('RGB', (8, 8))]
+    instrument.reset_stats()
+    with instrument.instrumented():
+        imgutils.square_montage(images)
+    stats = instrument.get_stats()
+    instrument.reset_stats()
+    assert stats['square_montage']['calls'] == 1
+    assert stats['render_montage']['calls'] == 1
+    # letterbox_resize is called through compositing's own binding
+    assert stats['letterbox_resize']['calls'] == 1
+    assert compositing.letterbox_resize is pil_utils.letterbox_resize
+    assert not hasattr(compositing.render_montage,
+                       '_imgutils_instrumented')